@@ -9,22 +9,45 @@ Enhanced with professional error handling and code structure
 """
 
 import os
+import io
+import re
+import glob
+import errno
+import shutil
 import sys
+import math
+import hashlib
+import hmac
+import functools
+import zlib
 import asyncio
 import traceback
 import logging
 import time
-from typing import Optional, Tuple, Dict, Any
+import contextvars
+import json
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple, Dict, Any, List, Union, BinaryIO, Callable, Awaitable
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field
 
 import motor.motor_asyncio
-from pyrogram import filters, enums
+from pymongo import UpdateOne
+from pyrogram import filters, enums, raw, idle
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session, Auth
 from pyromod import Client
 from pyrogram.types import (
     Message, 
     InlineKeyboardMarkup, 
-    InlineKeyboardButton
+    InlineKeyboardButton,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaAudio,
+    InputMediaDocument,
+    Photo
 )
 from pyrogram.errors import (
     FloodWait, 
@@ -40,7 +63,17 @@ from pyrogram.errors import (
     SessionPasswordNeeded,
     PasswordHashInvalid,
     PeerIdInvalid,
-    UserNotParticipant
+    UserNotParticipant,
+    MessageNotModified,
+    AuthKeyUnregistered,
+    AuthKeyInvalid,
+    SessionRevoked,
+    UserDeactivated,
+    UserDeactivatedBan,
+    ChannelPrivate,
+    ChannelInvalid,
+    AuthBytesInvalid,
+    FileReferenceExpired
 )
 
 # ============================================================================
@@ -60,6 +93,7 @@ class Config:
     
     # Optional configurations
     STRING_SESSION: Optional[str] = os.environ.get("STRING_SESSION", None)
+    STRING_SESSIONS: list = field(default_factory=lambda: os.environ.get("STRING_SESSIONS", "").replace(",", " ").split())
     CHANNEL_ID: Optional[str] = os.environ.get("CHANNEL_ID", None)
     ADMINS: list = field(default_factory=lambda: [int(x) for x in os.environ.get("ADMINS", "").split() if x.isdigit()])
 
@@ -71,9 +105,54 @@ class Config:
     WAITING_TIME: int = int(os.environ.get("WAITING_TIME", "2"))
     MAX_WORKERS: int = int(os.environ.get("MAX_WORKERS", "150"))
     SLEEP_THRESHOLD: int = int(os.environ.get("SLEEP_THRESHOLD", "5"))
+    BROADCAST_CONCURRENCY: int = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+    BROADCAST_RATE: int = int(os.environ.get("BROADCAST_RATE", "25"))
+    BROADCAST_STATUS_INTERVAL: int = int(os.environ.get("BROADCAST_STATUS_INTERVAL", "15"))
+    PREFETCH_DEPTH: int = int(os.environ.get("PREFETCH_DEPTH", "2"))
+    MAX_ACTIVE_JOBS: int = int(os.environ.get("MAX_ACTIVE_JOBS", "20"))
+    USER_MAX_JOBS: int = int(os.environ.get("USER_MAX_JOBS", "1"))
+    USER_MAX_QUEUED: int = int(os.environ.get("USER_MAX_QUEUED", "5"))
+    MAX_BATCH_MESSAGES: int = int(os.environ.get("MAX_BATCH_MESSAGES", "100000"))
+    MAX_TRANSFERS: int = int(os.environ.get("MAX_TRANSFERS", "10"))
+    USER_MAX_TRANSFERS: int = int(os.environ.get("USER_MAX_TRANSFERS", "2"))
+    PROGRESS_INTERVAL: int = int(os.environ.get("PROGRESS_INTERVAL", "10"))
+    CHAT_EDIT_INTERVAL: int = int(os.environ.get("CHAT_EDIT_INTERVAL", "3"))
+    EDITS_PER_SECOND: int = int(os.environ.get("EDITS_PER_SECOND", "20"))
+    
+    # Transfer settings
+    DISKLESS_TRANSFER: bool = os.environ.get("DISKLESS_TRANSFER", "True").lower() == "true"
+    IN_MEMORY_MAX_SIZE: int = int(os.environ.get("IN_MEMORY_MAX_SIZE", str(20 * 1024 * 1024)))
+    THUMB_CACHE_BYTES: int = int(os.environ.get("THUMB_CACHE_BYTES", str(32 * 1024 * 1024)))
+    PARALLEL_DOWNLOADS: int = int(os.environ.get("PARALLEL_DOWNLOADS", "4"))
+    PARALLEL_UPLOADS: int = int(os.environ.get("PARALLEL_UPLOADS", "4"))
+    PARALLEL_MIN_SIZE: int = int(os.environ.get("PARALLEL_MIN_SIZE", str(10 * 1024 * 1024)))
+    
+    # Scratch storage (0 quota = free space of the scratch dirs)
+    SCRATCH_DIRS: list = field(default_factory=lambda: os.environ.get("SCRATCH_DIRS", "downloads").split())
+    STORAGE_QUOTA: int = int(os.environ.get("STORAGE_QUOTA", "0"))
+    STORAGE_RESERVE: int = int(os.environ.get("STORAGE_RESERVE", str(256 * 1024 * 1024)))
+    STORAGE_WAIT_TIMEOUT: int = int(os.environ.get("STORAGE_WAIT_TIMEOUT", "600"))
     
     # Session settings
     SESSION_STRING_SIZE: int = 351
+    MAX_USER_SESSIONS: int = int(os.environ.get("MAX_USER_SESSIONS", "50"))
+    USER_CACHE_SIZE: int = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL: int = int(os.environ.get("USER_CACHE_TTL", "300"))
+    MESSAGE_CACHE_SIZE: int = int(os.environ.get("MESSAGE_CACHE_SIZE", "5000"))
+    MESSAGE_CACHE_TTL: int = int(os.environ.get("MESSAGE_CACHE_TTL", "1800"))
+    ACTIVITY_FLUSH_INTERVAL: int = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+    ACTIVITY_BUFFER_SIZE: int = int(os.environ.get("ACTIVITY_BUFFER_SIZE", "1000"))
+    SESSION_IDLE_TIMEOUT: int = int(os.environ.get("SESSION_IDLE_TIMEOUT", "600"))
+    
+    # Health, readiness and metrics endpoints (PORT is set by Render/Heroku)
+    HTTP_HOST: str = os.environ.get("HTTP_HOST", "0.0.0.0")
+    HTTP_PORT: int = int(os.environ.get("PORT", "10000"))
+    READY_TIMEOUT: float = float(os.environ.get("READY_TIMEOUT", "3"))
+    # /metrics has its own bind, loopback unless deliberately exposed (0 = off);
+    # with a token it is also served on PORT to "Authorization: Bearer <token>"
+    METRICS_HOST: str = os.environ.get("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT: int = int(os.environ.get("METRICS_PORT", "9101"))
+    METRICS_TOKEN: str = os.environ.get("METRICS_TOKEN", "")
     
     def validate(self) -> bool:
         """Validate required configurations"""
@@ -146,19 +225,483 @@ For downloading restricted content /login first.
 
 Know how to use bot by - /help</b>"""
 
+# ============================================================================
+# CACHE UTILITIES
+# ============================================================================
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry"""
+    
+    MISSING = object()
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+    
+    def get(self, key, default=MISSING):
+        """Return cached value, or default when absent or expired"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key, value, ttl: Optional[float] = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0
+        }
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+class Metric:
+    """Labelled Prometheus metric kept in process memory"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    
+    @staticmethod
+    def _labels(pairs: List[Tuple[str, str]]) -> str:
+        if not pairs:
+            return ""
+        escaped = (
+            (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+    
+    def samples(self):
+        """(suffix, label pairs, value) for every series"""
+        for key, value in self._values.items():
+            yield "", list(zip(self.labelnames, key)), value
+    
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        for suffix, pairs, value in self.samples():
+            # Full precision: byte counters outgrow %g's six digits quickly
+            number = int(value) if float(value).is_integer() else float(value)
+            lines.append(f"{self.name}{suffix}{self._labels(pairs)} {number!r}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        # Read live values at scrape time instead of tracking them
+        self.collect = collect
+    
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+    
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.error(f"Error collecting {self.name}: {e}")
+            return
+        for key, value in values.items():
+            yield "", list(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (per-bucket counts, sum, count)
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+    
+    def samples(self):
+        for key, (counts, total, count) in self._series.items():
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", pairs + [("le", f"{bound:g}")], cumulative
+            yield "_bucket", pairs + [("le", "+Inf")], count
+            yield "_sum", pairs, total
+            yield "_count", pairs, count
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+    
+    def __init__(self):
+        self._metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class BotMetrics:
+    """Metrics exported on /metrics"""
+    
+    TRANSFER_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    MONGO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+    
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        register = self.registry.register
+        self.download_bytes = register(Counter(
+            "vj_download_bytes_total", "Bytes downloaded from source chats", ("media_type",)
+        ))
+        self.upload_bytes = register(Counter(
+            "vj_upload_bytes_total", "Bytes uploaded by the bot", ("media_type",)
+        ))
+        self.transfer_seconds = register(Histogram(
+            "vj_transfer_duration_seconds",
+            "Duration of one download or upload",
+            ("direction", "media_type"),
+            self.TRANSFER_BUCKETS
+        ))
+        self.floodwait_seconds = register(Counter(
+            "vj_floodwait_seconds_total",
+            "FloodWait seconds imposed by Telegram, by raw function",
+            ("method",)
+        ))
+        self.floodwaits = register(Counter(
+            "vj_floodwaits_total",
+            "FloodWait errors received by the bot, user clients and parallel transfer "
+            "sessions, by raw function (not Pyrogram's own sequential file transfers)",
+            ("method",)
+        ))
+        self.mongo_seconds = register(Histogram(
+            "vj_mongo_operation_seconds",
+            "Latency of Mongo round trips by Database method and collection call "
+            "(cursors not included)",
+            ("method", "operation"),
+            self.MONGO_BUCKETS
+        ))
+        register(Gauge(
+            "vj_batches", "Batch jobs by state", ("state",),
+            collect=lambda: {
+                ("running",): job_scheduler.stats()['running'],
+                ("queued",): job_scheduler.stats()['queued']
+            }
+        ))
+        register(Gauge(
+            "vj_transfers_active", "Downloads and uploads holding a transfer slot",
+            collect=lambda: {(): job_scheduler.stats()['transfers']}
+        ))
+        register(Gauge(
+            "vj_broadcast_users", "Progress of running broadcasts", ("broadcast", "state"),
+            collect=lambda: broadcast_engine.progress()
+        ))
+    
+    def record_transfer(self, direction: str, media_type: str, size: int, seconds: float):
+        counter = self.download_bytes if direction == "download" else self.upload_bytes
+        counter.inc(size, media_type=media_type)
+        self.transfer_seconds.observe(seconds, direction=direction, media_type=media_type)
+    
+    def record_flood(self, method: str, seconds: float):
+        self.floodwaits.inc(method=method)
+        self.floodwait_seconds.inc(seconds, method=method)
+    
+    def timed(self, cls):
+        """Class decorator labelling Mongo calls with the public method making them"""
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or not asyncio.iscoroutinefunction(func):
+                continue
+            setattr(cls, name, self._labelled(func, name))
+        return cls
+    
+    @staticmethod
+    def _labelled(func, method: str):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = mongo_method.set(method)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                mongo_method.reset(token)
+        return wrapper
+    
+    def collection(self, collection) -> "TimedCollection":
+        """Motor collection whose round trips are observed in mongo_seconds"""
+        return TimedCollection(collection, self.mongo_seconds)
+
+# Innermost Database method running in this task, labels its Mongo calls
+mongo_method: contextvars.ContextVar = contextvars.ContextVar("mongo_method", default="")
+
+class TimedCollection:
+    """Motor collection proxy timing each awaited call
+
+    Only real round trips are timed, so cache hits and buffered writes
+    in Database never show up as near-zero latencies, and a call made by
+    nested methods is counted once, under the innermost one.
+    """
+    
+    TIMED = frozenset({
+        'find_one', 'insert_one', 'update_one', 'replace_one', 'delete_many',
+        'count_documents', 'bulk_write', 'create_index'
+    })
+    
+    def __init__(self, collection, histogram: Histogram):
+        self._collection = collection
+        self._histogram = histogram
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if name not in self.TIMED:
+            return attr
+        operation = f"{self._collection.name}.{name}"
+        
+        @functools.wraps(attr)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                self._histogram.observe(
+                    time.perf_counter() - started,
+                    method=mongo_method.get() or "background",
+                    operation=operation
+                )
+        return timed
+
+bot_metrics = BotMetrics()
+
 # ============================================================================
 # DATABASE CLASS
 # ============================================================================
 
+class ActivityBuffer:
+    """Write-behind buffer flushing last_active timestamps in bulk"""
+    
+    def __init__(self, col, flush_interval: float, max_pending: int):
+        self.col = col
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self.flushed = 0
+        self.dropped = 0
+        self._pending: Dict[int, datetime] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # At most one early flush outstanding, however many touches overflow
+        self._early_flush: Optional[asyncio.Task] = None
+    
+    def touch(self, user_id: int):
+        """Record activity without a database round trip"""
+        user_id = int(user_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= self.max_pending:
+            if self._early_flush is None or self._early_flush.done():
+                self._early_flush = asyncio.create_task(self.flush())
+            elif user_id not in self._pending:
+                # A flush is still writing: stay bounded, drop the new user
+                self.dropped += 1
+                return
+        self._pending[user_id] = datetime.now()
+    
+    async def flush(self):
+        """Write buffered timestamps as one unordered bulk_write"""
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            ops = [
+                UpdateOne({'id': user_id}, {'$set': {'last_active': ts}})
+                for user_id, ts in batch.items()
+            ]
+            try:
+                await self.col.bulk_write(ops, ordered=False)
+                self.flushed += len(ops)
+            except Exception as e:
+                logger.error(f"Error flushing activity of {len(ops)} users: {e}")
+                # Keep newer timestamps recorded meanwhile, drop beyond the bound
+                for user_id, ts in batch.items():
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    self._pending.setdefault(user_id, ts)
+    
+    async def close(self):
+        """Stop periodic flushing and write what is left"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+@dataclass
+class Cohort:
+    """Broadcast audience selected by activity, login state and sampling"""
+    active_since: Optional[datetime] = None
+    logged_in: bool = False
+    sample_percent: Optional[float] = None
+    seed: str = ""
+    
+    @classmethod
+    def parse(cls, args: List[str]) -> "Cohort":
+        """Build cohort from command args like: active:7 logged_in sample:10"""
+        cohort = cls(seed=str(int(time.time())))
+        for arg in args:
+            name, _, value = arg.lower().partition(":")
+            if name == "active":
+                cohort.active_since = datetime.now() - timedelta(days=int(value))
+            elif name in ("logged_in", "loggedin"):
+                cohort.logged_in = True
+            elif name == "sample":
+                cohort.sample_percent = float(value.rstrip("%"))
+                if not 0 < cohort.sample_percent <= 100:
+                    raise ValueError("sample must be between 0 and 100")
+            elif name != "all":
+                raise ValueError(f"unknown cohort filter: {arg}")
+        return cohort
+    
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "Cohort":
+        return cls(**data) if data else cls()
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'active_since': self.active_since,
+            'logged_in': self.logged_in,
+            'sample_percent': self.sample_percent,
+            'seed': self.seed
+        }
+    
+    def query(self) -> Dict[str, Any]:
+        """Mongo filter, shaped to match the cohort indexes"""
+        query: Dict[str, Any] = {}
+        if self.active_since is not None:
+            query['last_active'] = {'$gte': self.active_since}
+        if self.logged_in:
+            query['session'] = {'$type': 'string'}
+        return query
+    
+    def includes(self, user_id: int) -> bool:
+        """Deterministic per-broadcast sampling on the user id"""
+        if self.sample_percent is None:
+            return True
+        bucket = zlib.crc32(f"{self.seed}:{user_id}".encode()) % 10000
+        return bucket < self.sample_percent * 100
+    
+    def describe(self) -> str:
+        parts = []
+        if self.active_since is not None:
+            parts.append(f"active since {self.active_since:%Y-%m-%d %H:%M}")
+        if self.logged_in:
+            parts.append("logged in")
+        if self.sample_percent is not None:
+            parts.append(f"{self.sample_percent:g}% sample")
+        return ", ".join(parts) or "all users"
+
+
+@bot_metrics.timed
 class Database:
     """Professional database handler with error handling"""
     
+    # Cursor batch size for id-only scans
+    CURSOR_BATCH_SIZE = 5000
+    
+    # Fields needed by handlers; never pull the whole document
+    USER_PROJECTION = {'_id': 0, 'id': 1, 'name': 1, 'session': 1, 'api_id': 1, 'api_hash': 1}
+    
     def __init__(self, uri: str, database_name: str):
         """Initialize database connection"""
         try:
             self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
             self.db = self._client[database_name]
-            self.col = self.db.users
+            self.col = bot_metrics.collection(self.db.users)
+            self.broadcasts = bot_metrics.collection(self.db.broadcasts)
+            self.jobs = bot_metrics.collection(self.db.jobs)
+            self._user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+            self._activity = ActivityBuffer(
+                self.col,
+                config.ACTIVITY_FLUSH_INTERVAL,
+                config.ACTIVITY_BUFFER_SIZE
+            )
             logger.info("Database connected successfully")
         except Exception as e:
             logger.error(f"Database connection failed: {e}")
@@ -177,24 +720,120 @@ class Database:
             'last_active': datetime.now()
         }
     
-    async def add_user(self, user_id: int, name: str) -> bool:
-        """Add new user to database"""
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get user record in one query, served from cache when fresh"""
+        user_id = int(user_id)
+        user = self._user_cache.get(user_id)
+        if user is not TTLCache.MISSING:
+            return user
         try:
-            user = self.new_user(user_id, name)
-            await self.col.insert_one(user)
-            logger.info(f"New user added: {user_id}")
+            user = await self.col.find_one({'id': user_id}, self.USER_PROJECTION)
+            self._user_cache.set(user_id, user)
+            return user
+        except Exception as e:
+            logger.error(f"Error getting user {user_id}: {e}")
+            return None
+    
+    def invalidate_user(self, user_id: int):
+        """Drop cached record after a write"""
+        self._user_cache.pop(int(user_id))
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        return self._user_cache.stats()
+    
+    async def ping(self) -> bool:
+        """Whether Mongo answers a ping"""
+        try:
+            await self._client.admin.command('ping')
             return True
         except Exception as e:
-            logger.error(f"Error adding user {user_id}: {e}")
+            logger.error(f"Error pinging database: {e}")
             return False
     
-    async def is_user_exist(self, user_id: int) -> bool:
-        """Check if user exists"""
+    async def ensure_indexes(self):
+        """Create collection indexes, run once at startup"""
+        try:
+            # Unique index cannot be built while duplicates exist
+            await self.dedupe_users()
+            await self.col.create_index('id', unique=True, name='id_unique')
+            await self.col.create_index('last_active', name='last_active')
+            await self.jobs.create_index('status', name='status')
+            # Covered id-ordered scans for activity cohorts
+            await self.col.create_index(
+                [('id', 1), ('last_active', 1)],
+                name='id_last_active'
+            )
+            # Logged-in cohort only touches users holding a session
+            # (descending key so it does not clash with id_unique)
+            await self.col.create_index(
+                [('id', -1)],
+                name='id_logged_in',
+                partialFilterExpression={'session': {'$type': 'string'}}
+            )
+            logger.info("Database indexes ensured")
+        except Exception as e:
+            logger.error(f"Error ensuring indexes: {e}")
+    
+    async def dedupe_users(self) -> int:
+        """One-time migration merging duplicate documents of the same user"""
+        migrations = bot_metrics.collection(self.db.migrations)
+        if await migrations.find_one({'_id': 'dedupe_users'}):
+            return 0
+        
+        removed = 0
+        pipeline = [
+            # Prefer the logged-in, most recently active document
+            {'$sort': {'session': -1, 'last_active': -1}},
+            {'$group': {
+                '_id': '$id',
+                'keep': {'$first': '$_id'},
+                'docs': {'$push': '$_id'},
+                'created_at': {'$min': '$created_at'},
+                'count': {'$sum': 1}
+            }},
+            {'$match': {'count': {'$gt': 1}}}
+        ]
+        async for group in self.col.aggregate(pipeline, allowDiskUse=True):
+            duplicates = [doc_id for doc_id in group['docs'] if doc_id != group['keep']]
+            result = await self.col.delete_many({'_id': {'$in': duplicates}})
+            removed += result.deleted_count
+            if group.get('created_at'):
+                await self.col.update_one(
+                    {'_id': group['keep']},
+                    {'$set': {'created_at': group['created_at']}}
+                )
+        
+        await migrations.insert_one({
+            '_id': 'dedupe_users',
+            'removed': removed,
+            'ran_at': datetime.now()
+        })
+        self._user_cache.clear()
+        logger.info(f"Removed {removed} duplicate user documents")
+        return removed
+    
+    async def register_user(self, user_id: int, name: str) -> bool:
+        """Insert user or refresh last_active in one atomic upsert, True if new"""
         try:
-            user = await self.col.find_one({'id': int(user_id)})
-            return bool(user)
+            now = datetime.now()
+            defaults = self.new_user(user_id, name)
+            for key in ('id', 'last_active'):
+                defaults.pop(key)
+            defaults['created_at'] = now
+            
+            result = await self.col.update_one(
+                {'id': int(user_id)},
+                {'$setOnInsert': defaults, '$set': {'last_active': now}},
+                upsert=True
+            )
+            if result.upserted_id is None:
+                return False
+            
+            self.invalidate_user(user_id)
+            logger.info(f"New user added: {user_id}")
+            return True
         except Exception as e:
-            logger.error(f"Error checking user existence {user_id}: {e}")
+            logger.error(f"Error registering user {user_id}: {e}")
             return False
     
     async def total_users_count(self) -> int:
@@ -206,35 +845,117 @@ class Database:
             logger.error(f"Error counting users: {e}")
             return 0
     
-    async def get_all_users(self):
-        """Get all users cursor"""
+    async def get_user_ids(
+        self,
+        after_id: Optional[int] = None,
+        limit: int = 500,
+        cohort: Optional[Cohort] = None
+    ) -> Optional[List[int]]:
+        """Next page of cohort user ids in ascending order, None on error"""
+        try:
+            query = cohort.query() if cohort else {}
+            query['id'] = {'$gt': after_id} if after_id is not None else {'$exists': True}
+            cursor = (
+                self.col.find(query, {'_id': 0, 'id': 1})
+                .sort('id', 1)
+                .limit(limit)
+                .batch_size(limit)
+            )
+            return [user['id'] async for user in cursor]
+        except Exception as e:
+            logger.error(f"Error getting user ids after {after_id}: {e}")
+            return None
+    
+    async def count_cohort(self, cohort: Cohort) -> int:
+        """Audience size of a cohort"""
+        try:
+            if cohort.sample_percent is None:
+                return await self.col.count_documents(cohort.query())
+            cursor = self.col.find(
+                cohort.query(), {'_id': 0, 'id': 1}
+            ).batch_size(self.CURSOR_BATCH_SIZE)
+            return sum([1 async for user in cursor if cohort.includes(user.get('id'))])
+        except Exception as e:
+            logger.error(f"Error counting cohort: {e}")
+            return 0
+    
+    async def delete_users(self, user_ids: List[int]) -> int:
+        """Delete many users in one query"""
+        if not user_ids:
+            return 0
+        try:
+            result = await self.col.delete_many({'id': {'$in': [int(u) for u in user_ids]}})
+            for user_id in user_ids:
+                self.invalidate_user(user_id)
+            logger.info(f"Users deleted: {result.deleted_count}")
+            return result.deleted_count
+        except Exception as e:
+            logger.error(f"Error deleting {len(user_ids)} users: {e}")
+            return 0
+    
+    async def save_broadcast(self, broadcast: Dict[str, Any]) -> bool:
+        """Insert or checkpoint a broadcast document"""
+        try:
+            await self.broadcasts.replace_one({'_id': broadcast['_id']}, broadcast, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving broadcast {broadcast.get('_id')}: {e}")
+            return False
+    
+    async def get_unfinished_broadcasts(self) -> List[Dict[str, Any]]:
+        """Broadcasts interrupted by a restart"""
+        try:
+            return await self.broadcasts.find({'status': 'running'}).to_list(length=None)
+        except Exception as e:
+            logger.error(f"Error getting unfinished broadcasts: {e}")
+            return []
+    
+    async def save_job(self, job: Dict[str, Any]) -> bool:
+        """Insert or replace a batch job document"""
+        try:
+            await self.jobs.replace_one({'_id': job['_id']}, job, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving job {job.get('_id')}: {e}")
+            return False
+    
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> bool:
+        """Update status or checkpoint of a batch job"""
+        try:
+            fields['updated_at'] = datetime.now()
+            await self.jobs.update_one({'_id': job_id}, {'$set': fields})
+            return True
+        except Exception as e:
+            logger.error(f"Error updating job {job_id}: {e}")
+            return False
+    
+    async def get_unfinished_jobs(self) -> List[Dict[str, Any]]:
+        """Batch jobs interrupted by a restart, oldest first"""
         try:
-            return self.col.find({})
+            cursor = self.jobs.find({'status': {'$in': ['queued', 'running']}}).sort('created_at', 1)
+            return await cursor.to_list(length=None)
         except Exception as e:
-            logger.error(f"Error getting all users: {e}")
+            logger.error(f"Error getting unfinished jobs: {e}")
             return []
     
     async def delete_user(self, user_id: int) -> bool:
         """Delete user from database"""
         try:
             await self.col.delete_many({'id': int(user_id)})
+            self.invalidate_user(user_id)
             logger.info(f"User deleted: {user_id}")
             return True
         except Exception as e:
             logger.error(f"Error deleting user {user_id}: {e}")
             return False
     
-    async def update_last_active(self, user_id: int) -> bool:
-        """Update user's last active time"""
-        try:
-            await self.col.update_one(
-                {'id': int(user_id)}, 
-                {'$set': {'last_active': datetime.now()}}
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Error updating last active {user_id}: {e}")
-            return False
+    def touch_user(self, user_id: int):
+        """Buffer last_active update, flushed in the background"""
+        self._activity.touch(user_id)
+    
+    async def flush_activity(self):
+        """Write buffered activity now (called on shutdown)"""
+        await self._activity.close()
     
     async def set_session(self, user_id: int, session: Optional[str]) -> bool:
         """Set user session"""
@@ -243,6 +964,7 @@ class Database:
                 {'id': int(user_id)}, 
                 {'$set': {'session': session}}
             )
+            self.invalidate_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error setting session {user_id}: {e}")
@@ -251,7 +973,7 @@ class Database:
     async def get_session(self, user_id: int) -> Optional[str]:
         """Get user session"""
         try:
-            user = await self.col.find_one({'id': int(user_id)})
+            user = await self.get_user(user_id)
             return user.get('session') if user else None
         except Exception as e:
             logger.error(f"Error getting session {user_id}: {e}")
@@ -264,6 +986,7 @@ class Database:
                 {'id': int(user_id)}, 
                 {'$set': {'api_id': api_id}}
             )
+            self.invalidate_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error setting API ID {user_id}: {e}")
@@ -272,7 +995,7 @@ class Database:
     async def get_api_id(self, user_id: int) -> Optional[int]:
         """Get user API ID"""
         try:
-            user = await self.col.find_one({'id': int(user_id)})
+            user = await self.get_user(user_id)
             return user.get('api_id') if user else None
         except Exception as e:
             logger.error(f"Error getting API ID {user_id}: {e}")
@@ -285,6 +1008,7 @@ class Database:
                 {'id': int(user_id)}, 
                 {'$set': {'api_hash': api_hash}}
             )
+            self.invalidate_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error setting API Hash {user_id}: {e}")
@@ -293,7 +1017,7 @@ class Database:
     async def get_api_hash(self, user_id: int) -> Optional[str]:
         """Get user API Hash"""
         try:
-            user = await self.col.find_one({'id': int(user_id)})
+            user = await self.get_user(user_id)
             return user.get('api_hash') if user else None
         except Exception as e:
             logger.error(f"Error getting API Hash {user_id}: {e}")
@@ -303,449 +1027,3495 @@ class Database:
 db = Database(config.DB_URI, config.DB_NAME)
 
 # ============================================================================
-# BATCH PROCESSING CLASS
+# LINK PARSING
 # ============================================================================
 
-class BatchManager:
-    """Manage batch processing state"""
-    
-    def __init__(self):
-        self._batch_states: Dict[int, bool] = {}
+# t.me/c/<chat>/<id>, t.me/b/<bot>/<id> and t.me/<username>/<id>, each with an
+# optional topic id before the message id, an optional -<end> and query string
+MESSAGE_LINK = re.compile(
+    r"(?:https?://)?(?:www\.)?(?:t|telegram)\.me/"
+    r"(?:(?P<kind>[cb])/|s/)?"
+    r"(?P<chat>\w+)"
+    r"(?:/(?P<topic>\d+))?"
+    r"/(?P<start>\d+)(?:\s*-\s*(?P<end>\d+))?"
+    r"(?:\?\S*)?",
+    re.IGNORECASE
+)
+
+
+@dataclass
+class LinkSegment:
+    """Inclusive range of message ids in one source chat"""
+    source: Union[int, str]
+    public: bool
+    from_id: int
+    to_id: int
     
-    def is_processing(self, user_id: int) -> bool:
-        """Check if user has active batch"""
-        return self._batch_states.get(user_id, False) == False
+    def __len__(self) -> int:
+        return self.to_id - self.from_id + 1
     
-    def start_batch(self, user_id: int):
-        """Start batch processing for user"""
-        self._batch_states[user_id] = False
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'source': self.source,
+            'public': self.public,
+            'from_id': self.from_id,
+            'to_id': self.to_id
+        }
     
-    def stop_batch(self, user_id: int):
-        """Stop batch processing for user"""
-        self._batch_states[user_id] = True
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LinkSegment":
+        return cls(data['source'], data['public'], data['from_id'], data['to_id'])
+
+
+def parse_links(text: str) -> List[LinkSegment]:
+    """Every message link in text, merged into non-overlapping ranges per chat"""
+    sources: Dict[Tuple[Union[int, str], bool], Union[int, str]] = {}
+    spans: Dict[Tuple[Union[int, str], bool], List[Tuple[int, int]]] = {}
     
-    def cancel_batch(self, user_id: int):
-        """Cancel batch processing for user"""
-        self._batch_states[user_id] = True
+    for match in MESSAGE_LINK.finditer(text):
+        kind = (match.group('kind') or '').lower()
+        chat = match.group('chat')
+        if kind == 'c':
+            if not chat.isdigit():
+                continue
+            source, public = int("-100" + chat), False
+        elif kind == 'b':
+            source, public = chat, False
+        else:
+            source, public = chat, True
+        
+        start = int(match.group('start'))
+        end = int(match.group('end') or start)
+        # Usernames are case-insensitive
+        key = (source.lower() if isinstance(source, str) else source, public)
+        sources.setdefault(key, source)
+        spans.setdefault(key, []).append((min(start, end), max(start, end)))
     
-    def is_cancelled(self, user_id: int) -> bool:
-        """Check if batch is cancelled"""
-        return self._batch_states.get(user_id, True) == True
-
-batch_manager = BatchManager()
+    # Chats keep the order they were first mentioned in
+    segments = []
+    for key, ranges in spans.items():
+        ranges.sort()
+        merged = [list(ranges[0])]
+        for start, end in ranges[1:]:
+            if start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        segments.extend(LinkSegment(sources[key], key[1], start, end) for start, end in merged)
+    return segments
 
 # ============================================================================
-# PROGRESS TRACKING
+# JOB SCHEDULER
 # ============================================================================
 
-class ProgressTracker:
-    """Handle download/upload progress tracking"""
+# Job whose code is running in the current task (inherited by its subtasks)
+current_job: contextvars.ContextVar = contextvars.ContextVar("current_job", default=None)
+
+
+@dataclass
+class BatchJob:
+    """Message ranges requested by one user, processed one after another"""
+    user_id: int
+    message: Message
+    segments: List[LinkSegment]
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    target: Optional[int] = None
+    # Index of the segment in progress and the last id delivered from it
+    segment: int = 0
+    last_done: Optional[int] = None
+    cancelled: bool = False
     
-    @staticmethod
-    def write_progress(message_id: int, progress_type: str, current: int, total: int):
-        """Write progress to file"""
+    def __post_init__(self):
+        if self.target is None:
+            self.target = int(config.CHANNEL_ID) if config.CHANNEL_ID else self.message.chat.id
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Job document persisted in Mongo"""
+        return {
+            '_id': self.id,
+            'user_id': self.user_id,
+            'chat_id': self.message.chat.id,
+            'request_msg_id': self.message.id,
+            'segments': [segment.to_dict() for segment in self.segments],
+            'segment': self.segment,
+            'target': self.target,
+            'last_done': self.last_done,
+            'status': 'queued',
+            'created_at': datetime.now()
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], message: Message) -> "BatchJob":
+        # Jobs saved before multi-link support hold a single range inline
+        segments = data.get('segments') or [data]
+        return cls(
+            data['user_id'],
+            message,
+            [LinkSegment.from_dict(segment) for segment in segments],
+            id=data['_id'],
+            target=data.get('target'),
+            segment=data.get('segment', 0),
+            last_done=data.get('last_done')
+        )
+    
+    @property
+    def current(self) -> LinkSegment:
+        return self.segments[min(self.segment, len(self.segments) - 1)]
+    
+    @property
+    def source(self) -> Union[int, str]:
+        return self.current.source
+    
+    @property
+    def public(self) -> bool:
+        return self.current.public
+    
+    @property
+    def from_id(self) -> int:
+        return self.current.from_id
+    
+    @property
+    def to_id(self) -> int:
+        return self.current.to_id
+    
+    @property
+    def next_id(self) -> int:
+        """First message id not yet delivered in the current segment"""
+        return self.from_id if self.last_done is None else max(self.from_id, self.last_done + 1)
+    
+    async def checkpoint(self, msg_id: int):
+        """Record that everything up to msg_id was delivered"""
+        self.last_done = msg_id
+        await db.update_job(self.id, {'last_done': msg_id})
+    
+    async def _advance(self):
+        """Move on to the next segment"""
+        self.segment += 1
+        self.last_done = None
+        await db.update_job(self.id, {'segment': self.segment, 'last_done': None})
+    
+    async def run(self, client: Client):
+        """Connect an account and push each range through the pipeline"""
+        await db.update_job(self.id, {'status': 'running'})
+        
+        completed = True
         try:
-            percentage = (current * 100 / total) if total > 0 else 0
-            filename = f'{message_id}{progress_type}status.txt'
-            with open(filename, "w") as f:
-                f.write(f"{percentage:.1f}%")
-        except Exception as e:
-            logger.error(f"Error writing progress: {e}")
+            while completed and self.segment < len(self.segments) and not self.cancelled:
+                if config.LOGIN_SYSTEM:
+                    completed = await self._run_logged_in(client)
+                else:
+                    completed = await self._run_pooled(client)
+                if completed and not self.cancelled:
+                    await self._advance()
+        except asyncio.CancelledError:
+            # Shutting down: stays 'running' and resumes on next start
+            raise
+        except Exception:
+            await db.update_job(self.id, {'status': 'failed'})
+            raise
+        finally:
+            await storage_manager.cleanup_job(self.id)
+        
+        if not completed:
+            status = 'failed'
+        else:
+            status = 'cancelled' if self.cancelled else 'completed'
+        await db.update_job(self.id, {'status': status})
     
-    @staticmethod
-    async def monitor_download_progress(
-        client: Client, 
-        status_file: str, 
-        message: Message, 
-        chat_id: int
-    ):
-        """Monitor download progress"""
-        # Wait for status file to be created
-        while not os.path.exists(status_file):
-            await asyncio.sleep(3)
+    async def _run_logged_in(self, client: Client) -> bool:
+        """Run on the user's own session"""
+        user = await db.get_user(self.user_id)
+        if not user or user.get('session') is None:
+            await self.message.reply(
+                "**For Downloading Restricted Content You Have To /login First.**"
+            )
+            return False
+        
+        try:
+            acc = await session_pool.acquire(
+                self.user_id,
+                user['session'],
+                user.get('api_id'),
+                user.get('api_hash')
+            )
+        except Exception as e:
+            logger.error(f"User client connection error: {e}")
+            await self.message.reply(
+                "**Your Login Session Expired. So /logout First Then Login Again By - /login**"
+            )
+            return False
         
-        # Monitor progress
-        while os.path.exists(status_file):
+        try:
+            await self._run_pipeline(client, acc, failover=False)
+        finally:
+            await session_pool.release(self.user_id, acc)
+        return True
+    
+    async def _run_pooled(self, client: Client) -> bool:
+        """Run on the shared worker accounts, failing over when one drops out"""
+        while True:
             try:
-                with open(status_file, "r") as f:
-                    progress_text = f.read()
-                
-                await client.edit_message_text(
-                    chat_id, 
-                    message.id, 
-                    f"**Downloaded:** **{progress_text}**"
-                )
-                await asyncio.sleep(10)
+                acc = await account_pool.acquire(self.source)
+            except LookupError as e:
+                await self.message.reply(f"**{e}**")
+                return False
+            
+            try:
+                await self._run_pipeline(client, acc, failover=True)
+                account_pool.report_access(acc, self.source, True)
+                return True
             except FloodWait as e:
-                await asyncio.sleep(e.value)
-            except Exception as e:
-                logger.error(f"Error monitoring download: {e}")
-                await asyncio.sleep(5)
+                account_pool.report_flood(acc, e.value)
+            except DEAD_ACCOUNT_ERRORS as e:
+                account_pool.report_dead(acc, e)
+            except NO_ACCESS_ERRORS:
+                account_pool.report_access(acc, self.source, False)
+            finally:
+                await account_pool.release(acc)
+            logger.warning(f"Job {self.id} failing over from {acc.name} at message {self.next_id}")
     
-    @staticmethod
-    async def monitor_upload_progress(
-        client: Client, 
-        status_file: str, 
-        message: Message, 
-        chat_id: int
+    async def _run_pipeline(self, client: Client, acc: Client, failover: bool):
+        pipeline = BatchPipeline(
+            client,
+            acc,
+            self.message,
+            config.PREFETCH_DEPTH,
+            on_delivered=self.checkpoint,
+            failover=failover
+        )
+        await pipeline.run(
+            self.source,
+            range(self.next_id, self.to_id + 1),
+            public=self.public
+        )
+
+
+class JobScheduler:
+    """Queue batch jobs and share transfer slots fairly between users"""
+    
+    def __init__(
+        self,
+        max_jobs: int,
+        user_max_jobs: int,
+        user_max_queued: int,
+        max_transfers: int,
+        user_max_transfers: int
     ):
-        """Monitor upload progress"""
-        # Wait for status file to be created
-        while not os.path.exists(status_file):
-            await asyncio.sleep(3)
-        
-        # Monitor progress
-        while os.path.exists(status_file):
+        self.max_jobs = max(1, max_jobs)
+        self.user_max_jobs = max(1, user_max_jobs)
+        self.user_max_queued = max(1, user_max_queued)
+        self.max_transfers = max(1, max_transfers)
+        self.user_max_transfers = max(1, user_max_transfers)
+        self._queue: List[BatchJob] = []
+        self._running: Dict[int, List[BatchJob]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._active_transfers = 0
+        self._user_transfers: Dict[int, int] = {}
+        # Users waiting for a transfer slot, in round-robin order
+        self._waiters: "OrderedDict[int, deque]" = OrderedDict()
+        self._closing = False
+    
+    # ------------------------------------------------------------------
+    # Jobs
+    # ------------------------------------------------------------------
+    
+    async def submit(self, client: Client, job: BatchJob) -> int:
+        """Persist and queue job, return its queue position (0 if it started at once)"""
+        queued = sum(1 for j in self._queue if j.user_id == job.user_id)
+        if queued >= self.user_max_queued:
+            raise OverflowError(f"at most {self.user_max_queued} queued batches per user")
+        await db.save_job(job.to_dict())
+        self._queue.append(job)
+        self._start_ready(client)
+        return self.position(job)
+    
+    async def resume(self, client: Client):
+        """Requeue jobs left unfinished by a restart"""
+        for data in await db.get_unfinished_jobs():
             try:
-                with open(status_file, "r") as f:
-                    progress_text = f.read()
-                
-                await client.edit_message_text(
-                    chat_id, 
-                    message.id, 
-                    f"**Uploaded:** **{progress_text}**"
+                message = await client.get_messages(data['chat_id'], data['request_msg_id'])
+                if not message or message.empty:
+                    raise ValueError("request message is gone")
+            except Exception as e:
+                logger.error(f"Cannot resume job {data['_id']}: {e}")
+                await db.update_job(data['_id'], {'status': 'failed'})
+                continue
+            
+            job = BatchJob.from_dict(data, message)
+            self._queue.append(job)
+            logger.info(f"Resuming job {job.id} from message {job.next_id}")
+            try:
+                await message.reply(
+                    f"**Bot Restarted. Resuming Your Task From Message {job.next_id}.**"
                 )
-                await asyncio.sleep(10)
-            except FloodWait as e:
-                await asyncio.sleep(e.value)
             except Exception as e:
-                logger.error(f"Error monitoring upload: {e}")
-                await asyncio.sleep(5)
-
-progress_tracker = ProgressTracker()
-
-# ============================================================================
-# MESSAGE HANDLER CLASS
-# ============================================================================
-
-class MessageHandler:
+                logger.error(f"Error notifying user {job.user_id}: {e}")
+        self._start_ready(client)
+    
+    def position(self, job: BatchJob) -> int:
+        """1-based position in the queue, 0 when running"""
+        try:
+            return self._queue.index(job) + 1
+        except ValueError:
+            return 0
+    
+    async def cancel(self, user_id: int) -> int:
+        """Cancel user's running and queued jobs, return how many"""
+        queued = [job for job in self._queue if job.user_id == user_id]
+        for job in queued:
+            job.cancelled = True
+            self._queue.remove(job)
+            await db.update_job(job.id, {'status': 'cancelled'})
+        # Running jobs stop at the next message and record it themselves
+        running = self._running.get(user_id, [])
+        for job in running:
+            job.cancelled = True
+        return len(queued) + len(running)
+    
+    def is_cancelled(self, user_id: int) -> bool:
+        """Whether the job running in this task (or all of user's jobs) was cancelled"""
+        job = current_job.get()
+        if job is not None:
+            return job.cancelled
+        return all(job.cancelled for job in self._running.get(user_id, []))
+    
+    async def shutdown(self):
+        """Cancel running jobs; they stay 'running' in the database and resume on start"""
+        self._closing = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _running_count(self) -> int:
+        return sum(len(jobs) for jobs in self._running.values())
+    
+    def _start_ready(self, client: Client):
+        """Start queued jobs in submission order while limits allow"""
+        if self._closing:
+            return
+        for job in list(self._queue):
+            if self._running_count() >= self.max_jobs:
+                break
+            if len(self._running.get(job.user_id, [])) >= self.user_max_jobs:
+                continue
+            self._queue.remove(job)
+            self._running.setdefault(job.user_id, []).append(job)
+            self._tasks[job.id] = asyncio.create_task(self._execute(client, job))
+    
+    async def _execute(self, client: Client, job: BatchJob):
+        current_job.set(job)
+        try:
+            await job.run(client)
+        except Exception as e:
+            logger.error(f"Batch job {job.id} failed: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            jobs = self._running.get(job.user_id, [])
+            if job in jobs:
+                jobs.remove(job)
+            if not jobs:
+                self._running.pop(job.user_id, None)
+            self._tasks.pop(job.id, None)
+            self._start_ready(client)
+    
+    # ------------------------------------------------------------------
+    # Transfer slots
+    # ------------------------------------------------------------------
+    
+    @asynccontextmanager
+    async def transfer(self, user_id: int):
+        """Hold one of the global transfer slots for user"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_id, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(user_id)
+            else:
+                self._drop_waiter(user_id, future)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+    
+    def _dispatch(self):
+        """Grant free slots one user at a time, rotating between users"""
+        while self._active_transfers < self.max_transfers:
+            for user_id in list(self._waiters):
+                if self._user_transfers.get(user_id, 0) < self.user_max_transfers:
+                    break
+            else:
+                return
+            
+            waiters = self._waiters[user_id]
+            future = waiters.popleft()
+            if waiters:
+                # Back of the line for this user's next transfer
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if future.done():
+                continue
+            
+            self._active_transfers += 1
+            self._user_transfers[user_id] = self._user_transfers.get(user_id, 0) + 1
+            future.set_result(None)
+    
+    def _release(self, user_id: int):
+        self._active_transfers -= 1
+        remaining = self._user_transfers.get(user_id, 1) - 1
+        if remaining > 0:
+            self._user_transfers[user_id] = remaining
+        else:
+            self._user_transfers.pop(user_id, None)
+        self._dispatch()
+    
+    def _drop_waiter(self, user_id: int, future: asyncio.Future):
+        waiters = self._waiters.get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[user_id]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running_count(),
+            'queued': len(self._queue),
+            'transfers': self._active_transfers,
+            'waiting': sum(len(w) for w in self._waiters.values())
+        }
+
+job_scheduler = JobScheduler(
+    config.MAX_ACTIVE_JOBS,
+    config.USER_MAX_JOBS,
+    config.USER_MAX_QUEUED,
+    config.MAX_TRANSFERS,
+    config.USER_MAX_TRANSFERS
+)
+
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
+
+class TokenBucket:
+    """Token bucket rate limiter"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take tokens if available without waiting"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+    
+    async def acquire(self, tokens: float = 1):
+        """Wait until tokens are available and take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class PacingController:
+    """AIMD request pacing per account and method class"""
+    
+    # (initial, maximum) requests per second for each method class
+    LIMITS = {
+        'get_messages': (2.0, 10.0),
+        'send': (1.0 / max(config.WAITING_TIME, 0.05), 30.0),
+        'edit': (1.0, 20.0)
+    }
+    # Raw functions counted against each method class
+    METHOD_CLASSES = {
+        'functions.messages.GetMessages': 'get_messages',
+        'functions.channels.GetMessages': 'get_messages',
+        'functions.messages.SendMessage': 'send',
+        'functions.messages.SendMedia': 'send',
+        'functions.messages.SendMultiMedia': 'send',
+        'functions.messages.ForwardMessages': 'send',
+        'functions.messages.EditMessage': 'edit'
+    }
+    MIN_RATE = 0.05
+    INCREASE = 0.2
+    DECREASE = 0.5
+    MAX_ATTEMPTS = 3
+    
+    @dataclass
+    class Budget:
+        rate: float
+        max_rate: float
+        next_at: float = 0.0
+        blocked_until: float = 0.0
+        successes: int = 0
+        flood_waits: int = 0
+    
+    def __init__(self):
+        self._budgets: Dict[Tuple[str, str], "PacingController.Budget"] = {}
+    
+    def _budget(self, account: str, method: str) -> "PacingController.Budget":
+        budget = self._budgets.get((account, method))
+        if budget is None:
+            initial, maximum = self.LIMITS[method]
+            budget = self.Budget(rate=min(initial, maximum), max_rate=maximum)
+            self._budgets[(account, method)] = budget
+        return budget
+    
+    async def wait(self, account: str, method: str):
+        """Sleep until the next request of this class may go out"""
+        budget = self._budget(account, method)
+        now = time.monotonic()
+        start = max(now, budget.next_at, budget.blocked_until)
+        budget.next_at = start + 1.0 / budget.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+    
+    def success(self, account: str, method: str):
+        """Additive increase"""
+        budget = self._budget(account, method)
+        budget.successes += 1
+        budget.rate = min(budget.max_rate, budget.rate + self.INCREASE)
+    
+    def flood(self, account: str, method: str, seconds: float):
+        """Multiplicative decrease and block until the FloodWait ends"""
+        budget = self._budget(account, method)
+        budget.flood_waits += 1
+        budget.rate = max(self.MIN_RATE, budget.rate * self.DECREASE)
+        budget.blocked_until = max(budget.blocked_until, time.monotonic() + seconds)
+        logger.warning(
+            f"FloodWait {seconds}s on {account}/{method}, rate now {budget.rate:.2f}/s"
+        )
+    
+    def blocked(self, account: str, method: str) -> bool:
+        return self._budget(account, method).blocked_until > time.monotonic()
+    
+    def classify(self, query) -> Optional[str]:
+        """Method class of a raw function, None if it is not paced"""
+        return self.METHOD_CLASSES.get(getattr(query, "QUALNAME", ""))
+    
+    async def call(
+        self,
+        account: str,
+        method: str,
+        func: Callable,
+        *args,
+        retry: bool = True,
+        **kwargs
+    ):
+        """Paced call of func, retried after FloodWait unless retry is off
+
+        Callers that can switch to another account pass retry=False and
+        get the FloodWait right away instead of waiting it out. The wait
+        itself is reported by PacedClient.invoke, not here.
+        """
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.wait(account, method)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait:
+                if not retry or attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                continue
+            self.success(account, method)
+            return result
+    
+    def rates(self) -> Dict[str, Dict[str, Any]]:
+        """Current pacing state per account/method, for tuning"""
+        return {
+            f"{account}/{method}": {
+                'rate': budget.rate,
+                'successes': budget.successes,
+                'flood_waits': budget.flood_waits,
+                'blocked': budget.blocked_until > time.monotonic()
+            }
+            for (account, method), budget in self._budgets.items()
+        }
+
+pacer = PacingController()
+
+class PacedClient(Client):
+    """Client that reports every FloodWait to the pacer
+
+    Pyrogram sleeps through waits under sleep_threshold inside the
+    session, so the pacer would never hear of them. Here the session
+    threshold is 0 and the short waits are slept (and reported) instead.
+    """
+    
+    async def invoke(self, query, *args, sleep_threshold: Optional[float] = None, **kwargs):
+        threshold = self.sleep_threshold if sleep_threshold is None else sleep_threshold
+        method = pacer.classify(query)
+        while True:
+            try:
+                return await super().invoke(query, *args, sleep_threshold=0, **kwargs)
+            except FloodWait as e:
+                bot_metrics.record_flood(type(query).__name__, e.value)
+                if method:
+                    pacer.flood(self.name, method, e.value)
+                if e.value > threshold:
+                    raise
+                logger.warning(f"Waiting {e.value}s for {type(query).__name__} (FloodWait)")
+                await asyncio.sleep(e.value)
+
+# ============================================================================
+# PROGRESS TRACKING
+# ============================================================================
+
+def humanbytes(size: float) -> str:
+    """Format byte count for status messages"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+class Transfer:
+    """Live progress of a single download or upload"""
+    
+    # Smoothing factor for the transfer rate moving average
+    RATE_SMOOTHING = 0.3
+    
+    def __init__(self, key: Tuple[int, int, str]):
+        self.key = key
+        self.kind = key[2]
+        self.current = 0
+        self.total = 0
+        self.rate = 0.0
+        self.started = time.monotonic()
+        self.error: Optional[BaseException] = None
+        self._last_update = self.started
+        self._done = asyncio.Event()
+    
+    async def update(self, current: int, total: int):
+        """Pyrogram progress callback, runs on the event loop"""
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        if elapsed > 0 and current > self.current:
+            sample = (current - self.current) / elapsed
+            self.rate = sample if not self.rate else (
+                self.RATE_SMOOTHING * sample + (1 - self.RATE_SMOOTHING) * self.rate
+            )
+        self.current = current
+        self.total = total
+        self._last_update = now
+    
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+    
+    @property
+    def percentage(self) -> float:
+        return (self.current * 100 / self.total) if self.total > 0 else 0.0
+    
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the current rate"""
+        if not self.rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.current) / self.rate)
+    
+    def finish(self, error: Optional[BaseException] = None):
+        if self.finished:
+            return
+        self.error = error
+        self._done.set()
+    
+    def render(self) -> str:
+        """Status message text"""
+        label = "Downloaded" if self.kind == "down" else "Uploaded"
+        text = f"**{label}:** **{self.percentage:.1f}%**"
+        if self.total:
+            text += f"\n{humanbytes(self.current)} / {humanbytes(self.total)}"
+        if self.rate:
+            text += f" • {humanbytes(self.rate)}/s"
+        eta = self.eta
+        if eta is not None:
+            text += f" • ETA {timedelta(seconds=int(eta))}"
+        return text
+
+
+class ProgressTracker:
+    """In-process registry of active transfers"""
+    
+    def __init__(self):
+        self._transfers: Dict[Tuple[int, int, str], Transfer] = {}
+    
+    def start(self, status_msg: Message, kind: str) -> Transfer:
+        """Register a transfer reported on status_msg ('down' or 'up')"""
+        transfer = Transfer((status_msg.chat.id, status_msg.id, kind))
+        self._transfers[transfer.key] = transfer
+        return transfer
+    
+    def finish(self, transfer: Transfer, error: Optional[BaseException] = None):
+        """Mark transfer done and drop it from the registry"""
+        transfer.finish(error)
+        self._transfers.pop(transfer.key, None)
+    
+    def active(self) -> List[Transfer]:
+        return list(self._transfers.values())
+    
+    def track(self, client: Client, status_msg: Message, kind: str) -> Transfer:
+        """Start a transfer and report it on status_msg"""
+        transfer = self.start(status_msg, kind)
+        edit_scheduler.track(client, status_msg, transfer)
+        return transfer
+
+progress_tracker = ProgressTracker()
+
+
+class ProgressEditScheduler:
+    """Coalesce status edits of all transfers under shared edit budgets"""
+    
+    TICK = 1.0
+    MAX_BACKOFF = 8.0
+    BACKOFF_DECAY = 0.9
+    
+    def __init__(self, interval: float, chat_interval: float, edits_per_second: float):
+        self.interval = interval
+        self.chat_interval = chat_interval
+        self.backoff = 1.0
+        self.edits = 0
+        self.skipped = 0
+        self.flood_waits = 0
+        self._budget = TokenBucket(edits_per_second)
+        self._tracked: Dict[Tuple[int, int], Tuple[Client, Transfer]] = {}
+        self._last_text: Dict[Tuple[int, int], str] = {}
+        self._last_edit: Dict[Tuple[int, int], float] = {}
+        self._chat_last_edit: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    def track(self, client: Client, status_msg: Message, transfer: Transfer):
+        """Report transfer on status_msg, replacing its previous transfer"""
+        self._tracked[(status_msg.chat.id, status_msg.id)] = (client, transfer)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'tracked': len(self._tracked),
+            'edits': self.edits,
+            'skipped': self.skipped,
+            'flood_waits': self.flood_waits,
+            'backoff': self.backoff
+        }
+    
+    async def _run(self):
+        """Edit loop, exits once no transfer is tracked"""
+        while self._tracked:
+            await asyncio.sleep(self.TICK)
+            try:
+                await self._tick()
+            except Exception as e:
+                logger.error(f"Error in progress edit scheduler: {e}")
+    
+    async def _tick(self):
+        now = time.monotonic()
+        
+        for key, (_, transfer) in list(self._tracked.items()):
+            if transfer.finished:
+                self._forget(key)
+        
+        if now < self._paused_until:
+            return
+        
+        # Under FloodWait pressure every interval is stretched by backoff
+        interval = self.interval * self.backoff
+        chat_interval = self.chat_interval * self.backoff
+        
+        due = []
+        for key, (client, transfer) in self._tracked.items():
+            if now - self._last_edit.get(key, 0.0) < interval:
+                continue
+            if pacer.blocked(client.name, "edit"):
+                continue
+            text = transfer.render()
+            if text == self._last_text.get(key):
+                self.skipped += 1
+                continue
+            due.append((self._last_edit.get(key, 0.0), key, client, text))
+        
+        # Stalest status messages go first
+        due.sort(key=lambda item: item[0])
+        batch = []
+        for _, key, client, text in due:
+            chat_id = key[0]
+            if now - self._chat_last_edit.get(chat_id, 0.0) < chat_interval:
+                continue
+            if not self._budget.try_acquire():
+                break
+            self._last_edit[key] = now
+            self._chat_last_edit[chat_id] = now
+            batch.append(self._edit(client, key, text))
+        
+        if not batch:
+            return
+        flooded = await asyncio.gather(*batch)
+        if not any(flooded):
+            self.backoff = max(1.0, self.backoff * self.BACKOFF_DECAY)
+    
+    async def _edit(self, client: Client, key: Tuple[int, int], text: str) -> bool:
+        """Edit one status message, return True on FloodWait"""
+        try:
+            await pacer.call(
+                client.name, "edit", client.edit_message_text,
+                key[0], key[1], text, retry=False
+            )
+            self._last_text[key] = text
+            self.edits += 1
+        except MessageNotModified:
+            self._last_text[key] = text
+        except FloodWait as e:
+            self.flood_waits += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.value)
+            self.backoff = min(self.MAX_BACKOFF, self.backoff * 2)
+            logger.warning(f"Progress edits paused for {e.value}s (backoff x{self.backoff:.1f})")
+            return True
+        except Exception as e:
+            logger.error(f"Error editing progress message: {e}")
+            self._forget(key)
+        return False
+    
+    def _forget(self, key: Tuple[int, int]):
+        self._tracked.pop(key, None)
+        self._last_text.pop(key, None)
+        self._last_edit.pop(key, None)
+
+edit_scheduler = ProgressEditScheduler(
+    config.PROGRESS_INTERVAL,
+    config.CHAT_EDIT_INTERVAL,
+    config.EDITS_PER_SECOND
+)
+
+# ============================================================================
+# TEMP STORAGE
+# ============================================================================
+
+class StorageManager:
+    """Scratch space for downloads under a byte quota shared by all jobs"""
+    
+    SHARED_DIR = "shared"
+    # Subdirectory the bot owns in each scratch dir; only it is ever swept
+    OWNED_DIR = "vjbot-scratch"
+    # Written by older versions of the bot into the working directory: status
+    # files, and media/thumbnails left in Pyrogram's default downloads/ dir
+    LEFTOVER_PATTERNS = ("*status.txt", os.path.join("downloads", "*"))
+    
+    def __init__(self, dirs: List[str], quota: int, reserve: int, wait_timeout: float):
+        self.dirs = [
+            os.path.abspath(os.path.join(d, self.OWNED_DIR))
+            for d in dirs or ["downloads"]
+        ]
+        self.quota = quota
+        self.reserve = reserve
+        self.wait_timeout = wait_timeout
+        self.rejected = 0
+        self._capacity: Dict[str, int] = dict.fromkeys(self.dirs, 0)
+        self._used: Dict[str, int] = dict.fromkeys(self.dirs, 0)
+        # path -> (scratch dir, reserved bytes)
+        self._files: Dict[str, Tuple[str, int]] = {}
+        self._changed = asyncio.Event()
+    
+    @property
+    def limit(self) -> int:
+        capacity = sum(self._capacity.values())
+        return min(capacity, self.quota) if self.quota else capacity
+    
+    def sweep(self):
+        """Delete leftovers of earlier runs in the owned dirs and measure free space"""
+        removed = 0
+        for directory in self.dirs:
+            os.makedirs(directory, exist_ok=True)
+            for entry in os.scandir(directory):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(f"Error removing leftover {entry.path}: {e}")
+        
+        for pattern in self.LEFTOVER_PATTERNS:
+            for path in glob.glob(pattern):
+                # Files only: downloads/vjbot-scratch (OWNED_DIR) is swept above
+                if not os.path.isfile(path) or os.path.basename(path) == self.OWNED_DIR:
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(f"Error removing leftover {path}: {e}")
+        
+        for directory in self.dirs:
+            self._capacity[directory] = max(0, shutil.disk_usage(directory).free - self.reserve)
+        logger.info(
+            f"Scratch space: {humanbytes(self.limit)} in {len(self.dirs)} dirs, "
+            f"{removed} leftovers removed"
+        )
+    
+    def _pick(self, size: int) -> Optional[str]:
+        """Scratch dir with the most room for size bytes, None when over quota"""
+        if sum(self._used.values()) + size > self.limit:
+            return None
+        room = {d: self._capacity[d] - self._used[d] for d in self.dirs}
+        directory = max(room, key=room.get)
+        return directory if room[directory] >= size else None
+    
+    async def allocate(self, name: str, size: int) -> str:
+        """Reserve size bytes and return a file path in the job's directory"""
+        if size > self.limit:
+            self.rejected += 1
+            raise OSError(errno.ENOSPC, f"{humanbytes(size)} does not fit in scratch space")
+        
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            directory = self._pick(size)
+            if directory is not None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.rejected += 1
+                raise OSError(errno.ENOSPC, "Scratch space is full, try again later")
+            # Wait for another job to free its files
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        
+        job = current_job.get()
+        job_dir = os.path.join(directory, job.id if job else self.SHARED_DIR)
+        os.makedirs(job_dir, exist_ok=True)
+        path = os.path.join(job_dir, f"{uuid.uuid4().hex[:8]}_{os.path.basename(name)}")
+        self._used[directory] += size
+        self._files[path] = (directory, size)
+        return path
+    
+    def release(self, path: str):
+        """Delete a scratch file and give its bytes back to the quota"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error removing file {path}: {e}")
+        entry = self._files.pop(path, None)
+        if entry:
+            directory, size = entry
+            self._used[directory] -= size
+            self._changed.set()
+    
+    async def cleanup_job(self, job_id: str):
+        """Remove a job's directory and everything still reserved in it"""
+        for directory in self.dirs:
+            job_dir = os.path.join(directory, job_id)
+            if not os.path.isdir(job_dir):
+                continue
+            # Rename first so a crash mid-delete leaves only a sweepable trash dir
+            trash = f"{job_dir}.trash-{uuid.uuid4().hex[:8]}"
+            try:
+                os.rename(job_dir, trash)
+            except OSError as e:
+                logger.error(f"Error cleaning up {job_dir}: {e}")
+                continue
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(shutil.rmtree, trash, ignore_errors=True)
+            )
+            prefix = job_dir + os.sep
+            for path in [p for p in self._files if p.startswith(prefix)]:
+                self.release(path)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'used': sum(self._used.values()),
+            'limit': self.limit,
+            'files': len(self._files),
+            'rejected': self.rejected
+        }
+
+storage_manager = StorageManager(
+    config.SCRATCH_DIRS,
+    config.STORAGE_QUOTA,
+    config.STORAGE_RESERVE,
+    config.STORAGE_WAIT_TIMEOUT
+)
+
+# ============================================================================
+# PARALLEL TRANSFER
+# ============================================================================
+
+class MediaSessionPool:
+    """Extra media connections per account and DC, opened on demand"""
+    
+    def __init__(self):
+        # (client, dc id) -> connected media sessions. Keyed by the client
+        # object, since a re-login reuses the name with a new auth key
+        self._sessions: Dict[Tuple[Client, int], List[Session]] = {}
+        self._auth_keys: Dict[Tuple[Client, int], bytes] = {}
+        self._locks: Dict[Tuple[Client, int], asyncio.Lock] = {}
+    
+    async def get(self, acc: Client, dc_id: int, count: int) -> List[Session]:
+        """At least `count` sessions of acc to dc_id"""
+        key = (acc, dc_id)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            sessions = self._sessions.setdefault(key, [])
+            if len(sessions) >= count:
+                return sessions[:count]
+            
+            test_mode = await acc.storage.test_mode()
+            auth_key = self._auth_keys.get(key)
+            authorize = False
+            if auth_key is None:
+                if dc_id == await acc.storage.dc_id():
+                    auth_key = await acc.storage.auth_key()
+                else:
+                    # One exported authorization covers every session on this key
+                    auth_key = await Auth(acc, dc_id, test_mode).create()
+                    authorize = True
+            
+            while len(sessions) < count:
+                session = Session(acc, dc_id, auth_key, test_mode, is_media=True)
+                await session.start()
+                if authorize:
+                    try:
+                        await self._import_authorization(acc, session, dc_id)
+                    except Exception:
+                        await session.stop()
+                        raise
+                    authorize = False
+                self._auth_keys[key] = auth_key
+                sessions.append(session)
+            return sessions[:count]
+    
+    @staticmethod
+    async def invoke(session: Session, query, sleep_threshold: float = 30):
+        """session.invoke that counts the FloodWaits it sleeps through
+
+        Media sessions bypass PacedClient.invoke, so their waits are
+        recorded here before being slept or raised.
+        """
+        while True:
+            try:
+                return await session.invoke(query, sleep_threshold=0)
+            except FloodWait as e:
+                bot_metrics.record_flood(type(query).__name__, e.value)
+                if e.value > sleep_threshold:
+                    raise
+                logger.warning(f"Waiting {e.value}s for {type(query).__name__} (FloodWait)")
+                await asyncio.sleep(e.value)
+    
+    @staticmethod
+    async def _import_authorization(acc: Client, session: Session, dc_id: int):
+        for _ in range(3):
+            exported = await acc.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            try:
+                await MediaSessionPool.invoke(
+                    session,
+                    raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes)
+                )
+                return
+            except AuthBytesInvalid:
+                continue
+        raise AuthBytesInvalid
+    
+    async def close(self, acc: Client):
+        """Stop every media session opened for acc"""
+        for key in [key for key in self._sessions if key[0] is acc]:
+            self._auth_keys.pop(key, None)
+            self._locks.pop(key, None)
+            for session in self._sessions.pop(key):
+                await self._stop(session)
+    
+    async def close_all(self):
+        for sessions in self._sessions.values():
+            for session in sessions:
+                await self._stop(session)
+        self._sessions.clear()
+        self._auth_keys.clear()
+        self._locks.clear()
+    
+    @staticmethod
+    async def _stop(session: Session):
+        try:
+            await session.stop()
+        except Exception as e:
+            logger.error(f"Error stopping media session: {e}")
+
+media_sessions = MediaSessionPool()
+
+
+class ParallelDownloader:
+    """Fetch file parts over several media sessions at once"""
+    
+    # GetFile offsets must be multiples of the limit; 1MB is the maximum
+    PART_SIZE = 1024 * 1024
+    MAX_RETRIES = 3
+    
+    def __init__(self, connections: int, min_size: int):
+        self.connections = connections
+        self.min_size = min_size
+    
+    def applicable(self, media_obj) -> bool:
+        """Whether media is large enough to be worth several connections"""
+        if self.connections < 2 or isinstance(media_obj, Photo):
+            return False
+        file_size = getattr(media_obj, 'file_size', 0) or 0
+        return file_size >= self.min_size and bool(getattr(media_obj, 'file_id', None))
+    
+    @staticmethod
+    def _location(file_id: FileId):
+        if file_id.file_type in (FileType.PHOTO, FileType.CHAT_PHOTO):
+            raise ValueError("Photos are downloaded sequentially")
+        return raw.types.InputDocumentFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    
+    async def _fetch_part(self, session: Session, location, part: int, size: int) -> bytes:
+        """Download one part, retrying network errors"""
+        offset = part * self.PART_SIZE
+        expected = min(self.PART_SIZE, size - offset)
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                result = await media_sessions.invoke(
+                    session,
+                    raw.functions.upload.GetFile(
+                        location=location,
+                        offset=offset,
+                        limit=self.PART_SIZE
+                    )
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+                logger.warning(f"Retrying part {part}: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            if not isinstance(result, raw.types.upload.File):
+                raise IOError("CDN-hosted files are downloaded sequentially")
+            if len(result.bytes) != expected:
+                raise IOError(f"Part {part} returned {len(result.bytes)} of {expected} bytes")
+            return result.bytes
+    
+    async def download(
+        self,
+        acc: Client,
+        media_obj,
+        path: str,
+        progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> str:
+        """Download media into a preallocated file, one worker per session"""
+        file_id = FileId.decode(media_obj.file_id)
+        location = self._location(file_id)
+        size = media_obj.file_size
+        sessions = await media_sessions.get(acc, file_id.dc_id, self.connections)
+        
+        parts = iter(range(math.ceil(size / self.PART_SIZE)))
+        done = 0
+        
+        async def worker(session: Session):
+            nonlocal done
+            for part in parts:
+                data = await self._fetch_part(session, location, part, size)
+                os.pwrite(fd, data, part * self.PART_SIZE)
+                done += len(data)
+                if progress:
+                    await progress(done, size)
+        
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            workers = [asyncio.create_task(worker(session)) for session in sessions]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+        except BaseException:
+            os.close(fd)
+            fd = None
+            os.remove(path)
+            raise
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return path
+    
+    async def stream(self, acc: Client, media_obj, start_part: int = 0):
+        """Yield parts in order while the next ones download in parallel"""
+        file_id = FileId.decode(media_obj.file_id)
+        location = self._location(file_id)
+        size = media_obj.file_size
+        sessions = await media_sessions.get(acc, file_id.dc_id, self.connections)
+        total_parts = math.ceil(size / self.PART_SIZE)
+        
+        pending: deque = deque()
+        next_part = start_part
+        try:
+            while next_part < total_parts or pending:
+                while next_part < total_parts and len(pending) < len(sessions):
+                    session = sessions[next_part % len(sessions)]
+                    pending.append(asyncio.create_task(
+                        self._fetch_part(session, location, next_part, size)
+                    ))
+                    next_part += 1
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+parallel_downloader = ParallelDownloader(config.PARALLEL_DOWNLOADS, config.PARALLEL_MIN_SIZE)
+
+
+class ParallelUploader:
+    """Send saveBigFilePart parts concurrently over several media sessions"""
+    
+    PART_SIZE = 512 * 1024
+    # Telegram only accepts out-of-order parts for big files
+    BIG_FILE_SIZE = 10 * 1024 * 1024
+    MAX_RETRIES = 3
+    
+    def __init__(self, connections: int):
+        self.connections = connections
+    
+    @staticmethod
+    def _size(path) -> int:
+        if isinstance(path, str):
+            return os.path.getsize(path) if os.path.isfile(path) else 0
+        if isinstance(path, io.BytesIO):
+            return path.getbuffer().nbytes
+        return 0
+    
+    def applicable(self, path) -> bool:
+        return self.connections >= 2 and self._size(path) > self.BIG_FILE_SIZE
+    
+    async def _save_part(self, session: Session, file_id: int, part: int, total_parts: int, data: bytes):
+        """Upload one part, retrying rejected parts and network errors"""
+        rpc = raw.functions.upload.SaveBigFilePart(
+            file_id=file_id,
+            file_part=part,
+            file_total_parts=total_parts,
+            bytes=data
+        )
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                if await media_sessions.invoke(session, rpc):
+                    return
+                error = IOError(f"Telegram rejected part {part}")
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt < self.MAX_RETRIES - 1:
+                logger.warning(f"Retrying upload part {part}: {error}")
+                await asyncio.sleep(1)
+        raise error
+    
+    async def upload(self, client: Client, path, progress=None, progress_args: tuple = ()):
+        """Upload a file path or BytesIO and return its InputFileBig"""
+        size = self._size(path)
+        total_parts = math.ceil(size / self.PART_SIZE)
+        file_id = client.rnd_id()
+        sessions = await media_sessions.get(client, await client.storage.dc_id(), self.connections)
+        
+        if isinstance(path, str):
+            name = os.path.basename(path)
+            fd = os.open(path, os.O_RDONLY)
+            read = lambda offset: os.pread(fd, self.PART_SIZE, offset)
+        else:
+            name = getattr(path, 'name', None) or 'file'
+            fd = None
+            buffer = path.getbuffer()
+            read = lambda offset: bytes(buffer[offset:offset + self.PART_SIZE])
+        
+        parts = iter(range(total_parts))
+        uploaded = 0
+        
+        async def worker(session: Session):
+            nonlocal uploaded
+            for part in parts:
+                data = read(part * self.PART_SIZE)
+                await self._save_part(session, file_id, part, total_parts, data)
+                uploaded += len(data)
+                if progress:
+                    result = progress(uploaded, size, *progress_args)
+                    if asyncio.iscoroutine(result):
+                        await result
+        
+        try:
+            workers = [asyncio.create_task(worker(session)) for session in sessions]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+        finally:
+            if fd is not None:
+                os.close(fd)
+            else:
+                buffer.release()
+        
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+
+parallel_uploader = ParallelUploader(config.PARALLEL_UPLOADS)
+
+# ============================================================================
+# STREAMING TRANSFER
+# ============================================================================
+
+class MediaStream:
+    """Upload source that pipes a user account's stream_media into the bot"""
+    
+    PART_SIZE = 512 * 1024
+    BIG_FILE_SIZE = 10 * 1024 * 1024
+    BUFFERED_CHUNKS = 4
+    
+    DEFAULT_NAMES = {
+        'Video': 'video.mp4',
+        'Audio': 'audio.mp3',
+        'Voice': 'voice.ogg',
+        'Animation': 'animation.mp4',
+        'Sticker': 'sticker.webp',
+        'Photo': 'photo.jpg'
+    }
+    
+    def __init__(self, acc: Client, msg: Message, media, msg_type: str):
+        self.acc = acc
+        self.msg = msg
+        self.media = media
+        self.msg_type = msg_type
+        # Error raised while reading from the source account, if any
+        self.error: Optional[Exception] = None
+        self.size: int = getattr(media, 'file_size', 0) or 0
+        # Pyrogram guesses the mime type from this name
+        self.name: str = (
+            getattr(media, 'file_name', None)
+            or self.DEFAULT_NAMES.get(msg_type, 'document')
+        )
+    
+    async def upload(self, client: Client, progress=None, progress_args: tuple = ()):
+        """Upload the stream as file parts and return the InputFile"""
+        is_big = self.size > self.BIG_FILE_SIZE
+        total_parts = max(1, math.ceil(self.size / self.PART_SIZE))
+        file_id = client.rnd_id()
+        md5_sum = hashlib.md5() if not is_big else None
+        
+        # Reader downloads the next chunks while the current part uploads
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=self.BUFFERED_CHUNKS)
+        reader = asyncio.create_task(self._read(chunks))
+        
+        buffer = bytearray()
+        part = 0
+        uploaded = 0
+        started = time.monotonic()
+        
+        # Big files accept parts out of order, so several sessions upload at once
+        sessions: List[Session] = []
+        if is_big and parallel_uploader.connections >= 2:
+            try:
+                sessions = await media_sessions.get(
+                    client, await client.storage.dc_id(), parallel_uploader.connections
+                )
+            except Exception as e:
+                logger.warning(f"Parallel upload unavailable, streaming sequentially: {e}")
+        parts: asyncio.Queue = asyncio.Queue(maxsize=2 * len(sessions) or 1)
+        failures: List[Exception] = []
+        
+        async def report(size: int):
+            nonlocal uploaded
+            uploaded += size
+            if progress:
+                result = progress(uploaded, self.size, *progress_args)
+                if asyncio.iscoroutine(result):
+                    await result
+        
+        async def worker(session: Session):
+            while True:
+                item = await parts.get()
+                if item is None:
+                    return
+                # After a failure keep draining so the reader never blocks
+                if failures:
+                    continue
+                index, data = item
+                try:
+                    await parallel_uploader._save_part(session, file_id, index, total_parts, data)
+                    await report(len(data))
+                except Exception as e:
+                    failures.append(e)
+        
+        workers = [asyncio.create_task(worker(session)) for session in sessions]
+        
+        async def send_part(data: bytes):
+            nonlocal part
+            if workers:
+                if failures:
+                    raise failures[0]
+                await parts.put((part, data))
+                part += 1
+                return
+            if is_big:
+                rpc = raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id,
+                    file_part=part,
+                    file_total_parts=total_parts,
+                    bytes=data
+                )
+            else:
+                rpc = raw.functions.upload.SaveFilePart(
+                    file_id=file_id,
+                    file_part=part,
+                    bytes=data
+                )
+                md5_sum.update(data)
+            if not await client.invoke(rpc):
+                raise IOError(f"Telegram rejected part {part} of {self.name}")
+            part += 1
+            await report(len(data))
+        
+        try:
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, Exception):
+                    self.error = chunk
+                    raise chunk
+                if chunk is None:
+                    break
+                buffer += chunk
+                while len(buffer) >= self.PART_SIZE:
+                    await send_part(bytes(buffer[:self.PART_SIZE]))
+                    del buffer[:self.PART_SIZE]
+            if buffer or part == 0:
+                await send_part(bytes(buffer))
+            for _ in workers:
+                await parts.put(None)
+            await asyncio.gather(*workers)
+            if failures:
+                raise failures[0]
+        finally:
+            reader.cancel()
+            for task in workers:
+                task.cancel()
+        
+        # Download and upload overlap, so both take the whole duration
+        elapsed = time.monotonic() - started
+        bot_metrics.record_transfer("download", self.msg_type, uploaded, elapsed)
+        bot_metrics.record_transfer("upload", self.msg_type, uploaded, elapsed)
+        
+        if is_big:
+            return raw.types.InputFileBig(id=file_id, parts=part, name=self.name)
+        return raw.types.InputFile(
+            id=file_id,
+            parts=part,
+            name=self.name,
+            md5_checksum=md5_sum.hexdigest()
+        )
+    
+    async def _read(self, chunks: asyncio.Queue):
+        """Feed downloaded chunks into the bounded queue"""
+        fed = 0
+        try:
+            if parallel_downloader.applicable(self.media):
+                try:
+                    try:
+                        async for chunk in parallel_downloader.stream(self.acc, self.media):
+                            await chunks.put(chunk)
+                            fed += 1
+                    except FileReferenceExpired:
+                        # Metadata may be older than its file reference
+                        fresh = await message_fetcher.refresh(self.acc, self.msg)
+                        media = getattr(fresh, self.msg_type.lower(), None)
+                        if media is None:
+                            raise
+                        self.msg, self.media = fresh, media
+                        async for chunk in parallel_downloader.stream(self.acc, self.media, fed):
+                            await chunks.put(chunk)
+                            fed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Parallel stream of {self.name} failed at part {fed}: {e}")
+                else:
+                    await chunks.put(None)
+                    return
+            
+            # Both use 1MB chunks, so the sequential path resumes where it stopped
+            async for chunk in self.acc.stream_media(self.msg, offset=fed):
+                await chunks.put(chunk)
+            await chunks.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await chunks.put(e)
+
+# ============================================================================
+# THUMBNAIL CACHE
+# ============================================================================
+
+class ThumbnailCache:
+    """In-memory LRU of thumbnail bytes keyed by file_unique_id"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks: set = set()
+    
+    def prefetch(self, acc: Client, media):
+        """Start fetching media's thumbnail in the background"""
+        thumb = self._thumb_of(media)
+        if thumb is None or thumb.file_unique_id in self._data:
+            return
+        task = asyncio.create_task(self._load(acc, thumb))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def get(self, acc: Client, media) -> Optional[BinaryIO]:
+        """Thumbnail of media as an in-memory file, None if it has none"""
+        thumb = self._thumb_of(media)
+        if thumb is None:
+            return None
+        data = await self._load(acc, thumb)
+        if data is None:
+            return None
+        buffer = io.BytesIO(data)
+        buffer.name = "thumb.jpg"
+        return buffer
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self._size,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0
+        }
+    
+    @staticmethod
+    def _thumb_of(media):
+        thumbs = getattr(media, 'thumbs', None)
+        return thumbs[0] if thumbs else None
+    
+    async def _load(self, acc: Client, thumb) -> Optional[bytes]:
+        key = thumb.file_unique_id
+        data = self._data.get(key)
+        if data is not None:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return data
+        
+        # Share a download already running for the same thumbnail
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        data = None
+        try:
+            buffer = await acc.download_media(thumb.file_id, in_memory=True)
+            data = bytes(buffer.getbuffer())
+            self._store(key, data)
+        except Exception as e:
+            logger.error(f"Error getting thumbnail: {e}")
+        finally:
+            future.set_result(data)
+            self._inflight.pop(key, None)
+        return data
+    
+    def _store(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        self._data[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self._size -= len(evicted)
+
+thumbnail_cache = ThumbnailCache(config.THUMB_CACHE_BYTES)
+
+# ============================================================================
+# MESSAGE HANDLER CLASS
+# ============================================================================
+
+class MessageHandler:
     """Handle different types of messages"""
     
     @staticmethod
-    def get_message_type(msg: Message) -> Optional[str]:
-        """Determine message type"""
-        type_checks = [
-            ('document', 'Document'),
-            ('video', 'Video'),
-            ('animation', 'Animation'),
-            ('sticker', 'Sticker'),
-            ('voice', 'Voice'),
-            ('audio', 'Audio'),
-            ('photo', 'Photo'),
-            ('text', 'Text')
-        ]
-        
-        for attr, msg_type in type_checks:
-            try:
-                if getattr(msg, attr):
-                    return msg_type
-            except AttributeError:
-                continue
-        
+    def get_message_type(msg: Message) -> Optional[str]:
+        """Determine message type"""
+        type_checks = [
+            ('document', 'Document'),
+            ('video', 'Video'),
+            ('animation', 'Animation'),
+            ('sticker', 'Sticker'),
+            ('voice', 'Voice'),
+            ('audio', 'Audio'),
+            ('photo', 'Photo'),
+            ('text', 'Text')
+        ]
+        
+        for attr, msg_type in type_checks:
+            try:
+                if getattr(msg, attr):
+                    return msg_type
+            except AttributeError:
+                continue
+        
+        return None
+    
+    @staticmethod
+    async def send_message_by_type(
+        client: Client,
+        chat_id: int,
+        media: Union[str, BinaryIO, "MediaStream"],
+        msg_type: str,
+        msg: Message,
+        message: Message,
+        acc: Client,
+        progress: Optional[Callable] = None
+    ):
+        """Send message based on type"""
+        caption = msg.caption if hasattr(msg, 'caption') else None
+        reply_to = message.id
+        send = functools.partial(pacer.call, client.name, "send")
+        started = time.monotonic()
+        
+        try:
+            if msg_type == "Text":
+                await send(
+                    client.send_message,
+                    chat_id, 
+                    msg.text, 
+                    entities=msg.entities,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML
+                )
+            
+            elif msg_type == "Document":
+                thumb = await MessageHandler._get_thumb(acc, msg.document)
+                await send(
+                    client.send_document,
+                    chat_id, 
+                    media,
+                    thumb=thumb,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML,
+                    progress=progress
+                )
+                MessageHandler._cleanup_file(thumb)
+            
+            elif msg_type == "Video":
+                thumb = await MessageHandler._get_thumb(acc, msg.video)
+                await send(
+                    client.send_video,
+                    chat_id, 
+                    media,
+                    duration=msg.video.duration,
+                    width=msg.video.width,
+                    height=msg.video.height,
+                    thumb=thumb,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML,
+                    progress=progress
+                )
+                MessageHandler._cleanup_file(thumb)
+            
+            elif msg_type == "Audio":
+                thumb = await MessageHandler._get_thumb(acc, msg.audio)
+                await send(
+                    client.send_audio,
+                    chat_id, 
+                    media,
+                    thumb=thumb,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML,
+                    progress=progress
+                )
+                MessageHandler._cleanup_file(thumb)
+            
+            elif msg_type == "Photo":
+                await send(
+                    client.send_photo,
+                    chat_id, 
+                    media,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML
+                )
+            
+            elif msg_type == "Animation":
+                await send(
+                    client.send_animation,
+                    chat_id, 
+                    media,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML
+                )
+            
+            elif msg_type == "Sticker":
+                await send(
+                    client.send_sticker,
+                    chat_id, 
+                    media,
+                    reply_to_message_id=reply_to
+                )
+            
+            elif msg_type == "Voice":
+                await send(
+                    client.send_voice,
+                    chat_id, 
+                    media,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    parse_mode=enums.ParseMode.HTML,
+                    progress=progress
+                )
+            
+            # Streams are measured end to end by MediaStream itself
+            if msg_type != "Text" and not isinstance(media, MediaStream):
+                bot_metrics.record_transfer(
+                    "upload", msg_type, ParallelUploader._size(media), time.monotonic() - started
+                )
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error sending {msg_type}: {e}")
+            raise
+    
+    @staticmethod
+    async def get_input_media(prepared: "PreparedMessage", acc: Client):
+        """Build send_media_group item for a prepared album member"""
+        msg = prepared.msg
+        caption = msg.caption if hasattr(msg, 'caption') else None
+        
+        if prepared.msg_type == "Photo":
+            return InputMediaPhoto(
+                prepared.media,
+                caption=caption,
+                parse_mode=enums.ParseMode.HTML
+            )
+        
+        if prepared.msg_type == "Video":
+            return InputMediaVideo(
+                prepared.media,
+                thumb=await MessageHandler._get_thumb(acc, msg.video),
+                caption=caption,
+                parse_mode=enums.ParseMode.HTML,
+                width=msg.video.width,
+                height=msg.video.height,
+                duration=msg.video.duration,
+                supports_streaming=True
+            )
+        
+        if prepared.msg_type == "Audio":
+            return InputMediaAudio(
+                prepared.media,
+                thumb=await MessageHandler._get_thumb(acc, msg.audio),
+                caption=caption,
+                parse_mode=enums.ParseMode.HTML,
+                duration=msg.audio.duration,
+                performer=msg.audio.performer,
+                title=msg.audio.title
+            )
+        
+        return InputMediaDocument(
+            prepared.media,
+            thumb=await MessageHandler._get_thumb(acc, msg.document),
+            caption=caption,
+            parse_mode=enums.ParseMode.HTML
+        )
+    
+    @staticmethod
+    async def _get_thumb(acc: Client, media) -> Optional[BinaryIO]:
+        """Get thumbnail for media"""
+        return await thumbnail_cache.get(acc, media)
+    
+    @staticmethod
+    def _cleanup_file(file_path: Optional[Union[str, BinaryIO]]):
+        """Clean up temporary file"""
+        if isinstance(file_path, io.IOBase):
+            file_path.close()
+        elif file_path:
+            storage_manager.release(file_path)
+
+message_handler = MessageHandler()
+
+# ============================================================================
+# CONTENT DOWNLOADER CLASS
+# ============================================================================
+
+@dataclass
+class PreparedMessage:
+    """Source message fetched (and downloaded) ahead of delivery"""
+    msg_id: int
+    msg: Optional[Message] = None
+    msg_type: Optional[str] = None
+    media: Optional[Union[str, BinaryIO, "MediaStream"]] = None
+    status_msg: Optional[Message] = None
+    copy_from: Optional[Message] = None
+    members: Optional[List["PreparedMessage"]] = None
+    # Members are copied together with one ForwardMessages call
+    bulk: bool = False
+
+
+class ContentDownloader:
+    """Handle content downloading and forwarding"""
+    
+    @staticmethod
+    async def handle_private_message(
+        client: Client,
+        acc: Client,
+        message: Message,
+        chat_id: int,
+        msg_id: int,
+        failover: bool = False
+    ) -> bool:
+        """Handle private channel message, True if it was sent"""
+        prepared = await ContentDownloader.prepare_private_message(
+            client, acc, message, chat_id, msg_id, failover=failover
+        )
+        if not prepared:
+            return False
+        return await ContentDownloader.deliver(client, acc, message, prepared, failover=failover)
+    
+    @staticmethod
+    async def prepare_private_message(
+        client: Client,
+        acc: Client,
+        message: Message,
+        chat_id: int,
+        msg_id: int,
+        msg: Optional[Message] = None,
+        failover: bool = False
+    ) -> Optional[PreparedMessage]:
+        """Fetch message (unless prefetched) and download its media
+
+        With failover, account-level errors of acc are raised to the caller
+        so it can switch accounts instead of skipping the message.
+        """
+        try:
+            # Get the message
+            if msg is None:
+                msg = await message_fetcher.get_message(acc, chat_id, msg_id)
+                if msg is None:
+                    return None
+            
+            if msg.empty:
+                logger.warning(f"Empty message: {chat_id}/{msg_id}")
+                return None
+            
+            # Determine message type
+            msg_type = message_handler.get_message_type(msg)
+            if not msg_type:
+                logger.warning(f"Unknown message type: {chat_id}/{msg_id}")
+                return None
+            
+            # Check if batch is cancelled
+            if job_scheduler.is_cancelled(message.from_user.id):
+                return None
+            
+            # Text messages have nothing to download
+            if msg_type == "Text":
+                return PreparedMessage(msg_id, msg=msg, msg_type=msg_type)
+            
+            # Thumbnail downloads alongside the main media
+            media_obj = getattr(msg, msg_type.lower(), None)
+            if msg_type in ("Document", "Video", "Audio"):
+                thumbnail_cache.prefetch(acc, media_obj)
+            
+            # Large media is piped chunk by chunk straight into the upload
+            if ContentDownloader._should_stream(media_obj):
+                status_msg = await ContentDownloader._send_status(
+                    client, message, '**Streaming...**'
+                )
+                return PreparedMessage(
+                    msg_id,
+                    msg=msg,
+                    msg_type=msg_type,
+                    media=MediaStream(acc, msg, media_obj, msg_type),
+                    status_msg=status_msg
+                )
+            
+            # Download media (small media stays in memory when diskless)
+            status_msg = await ContentDownloader._send_status(
+                client, message, '**Downloading...**'
+            )
+            
+            transfer = progress_tracker.track(client, status_msg, "down")
+            try:
+                media = await ContentDownloader._download(
+                    acc, msg, media_obj, msg_type, transfer.update
+                )
+            except Exception as e:
+                progress_tracker.finish(transfer, e)
+                await ContentDownloader.discard(
+                    client, PreparedMessage(msg_id, status_msg=status_msg)
+                )
+                if failover and isinstance(e, ACCOUNT_ERRORS):
+                    raise
+                logger.error(f"Download error: {e}")
+                await ContentDownloader._report_error(client, message, f"Download Error: {e}")
+                return None
+            finally:
+                progress_tracker.finish(transfer)
+            
+            return PreparedMessage(
+                msg_id,
+                msg=msg,
+                msg_type=msg_type,
+                media=media,
+                status_msg=status_msg
+            )
+            
+        except Exception as e:
+            if failover and isinstance(e, ACCOUNT_ERRORS):
+                raise
+            logger.error(f"Error handling private message: {e}")
+            await ContentDownloader._report_error(client, message, f"Error: {e}")
+            return None
+    
+    @staticmethod
+    def target_chat(message: Message) -> int:
+        """Chat uploads go to, as recorded on the running job"""
+        job = current_job.get()
+        if job is not None:
+            return job.target
+        return int(config.CHANNEL_ID) if config.CHANNEL_ID else message.chat.id
+    
+    @staticmethod
+    async def _download(acc: Client, msg: Message, media_obj, msg_type: str, progress):
+        """Download media, recording its size and duration"""
+        started = time.monotonic()
+        try:
+            media = await ContentDownloader._fetch_media(acc, msg, media_obj, msg_type, progress)
+        except FileReferenceExpired:
+            media = None
+        if media is None:
+            # Batches fetch metadata a chunk ahead, so the file reference may
+            # have expired by now (Pyrogram only logs that); retry once
+            logger.warning(f"Download of {msg.chat.id}/{msg.id} failed, refetching the message")
+            msg = await message_fetcher.refresh(acc, msg)
+            media_obj = getattr(msg, msg_type.lower(), None)
+            if media_obj is None:
+                raise IOError("Message is no longer available")
+            media = await ContentDownloader._fetch_media(acc, msg, media_obj, msg_type, progress)
+            if media is None:
+                raise IOError("Download failed")
+        bot_metrics.record_transfer(
+            "download",
+            msg_type,
+            getattr(media_obj, 'file_size', 0) or 0,
+            time.monotonic() - started
+        )
+        return media
+    
+    @staticmethod
+    async def _fetch_media(acc: Client, msg: Message, media_obj, msg_type: str, progress):
+        """Download into memory or reserved scratch space, in parallel when possible
+
+        Returns None when Pyrogram gives up on the download.
+        """
+        if config.DISKLESS_TRANSFER:
+            return await acc.download_media(msg, in_memory=True, progress=progress)
+        
+        # Preflight: wait for (or refuse) quota before any byte is written
+        name = getattr(media_obj, 'file_name', None) or MediaStream.DEFAULT_NAMES.get(msg_type, 'document')
+        path = await storage_manager.allocate(name, getattr(media_obj, 'file_size', 0) or 0)
+        try:
+            if parallel_downloader.applicable(media_obj):
+                try:
+                    return await parallel_downloader.download(acc, media_obj, path, progress)
+                except (asyncio.CancelledError, FileReferenceExpired):
+                    raise
+                except Exception as e:
+                    logger.warning(f"Parallel download failed, falling back to sequential: {e}")
+            result = await acc.download_media(msg, file_name=path, progress=progress)
+            if result is None:
+                storage_manager.release(path)
+            return result
+        except BaseException:
+            storage_manager.release(path)
+            raise
+    
+    @staticmethod
+    def _should_stream(media_obj) -> bool:
+        """Whether media is too large for an in-memory buffer"""
+        file_size = getattr(media_obj, 'file_size', 0) or 0
+        return config.DISKLESS_TRANSFER and file_size > config.IN_MEMORY_MAX_SIZE
+    
+    @staticmethod
+    async def prepare_album(
+        client: Client,
+        acc: Client,
+        message: Message,
+        msgs: List[Message],
+        failover: bool = False
+    ) -> Optional[PreparedMessage]:
+        """Download all members of a media group concurrently"""
+        try:
+            status_msg = await ContentDownloader._send_status(
+                client, message, f'**Downloading album ({len(msgs)} files)...**'
+            )
+        except RuntimeError as e:
+            logger.error(f"Skipping album {msgs[0].media_group_id}: {e}")
+            return None
+        transfer = progress_tracker.track(client, status_msg, "down")
+        
+        # Album progress is the sum of its members' progress
+        totals: Dict[int, int] = {}
+        for msg in msgs:
+            media_obj = getattr(msg, message_handler.get_message_type(msg).lower(), None)
+            totals[msg.id] = getattr(media_obj, 'file_size', 0) or 0
+        done = dict.fromkeys(totals, 0)
+        
+        async def fetch(msg: Message) -> PreparedMessage:
+            msg_type = message_handler.get_message_type(msg)
+            media_obj = getattr(msg, msg_type.lower(), None)
+            if msg_type in ("Document", "Video", "Audio"):
+                thumbnail_cache.prefetch(acc, media_obj)
+            if ContentDownloader._should_stream(media_obj):
+                return PreparedMessage(
+                    msg.id,
+                    msg=msg,
+                    msg_type=msg_type,
+                    media=MediaStream(acc, msg, media_obj, msg_type)
+                )
+            
+            async def progress(current: int, total: int):
+                done[msg.id] = current
+                await transfer.update(sum(done.values()), sum(totals.values()))
+            
+            media = await ContentDownloader._download(acc, msg, media_obj, msg_type, progress)
+            return PreparedMessage(msg.id, msg=msg, msg_type=msg_type, media=media)
+        
+        try:
+            results = await asyncio.gather(*(fetch(msg) for msg in msgs), return_exceptions=True)
+        finally:
+            progress_tracker.finish(transfer)
+        
+        if failover:
+            for result in results:
+                if isinstance(result, ACCOUNT_ERRORS):
+                    # The whole album is retried on another account
+                    await ContentDownloader.discard(client, PreparedMessage(
+                        msgs[0].id,
+                        status_msg=status_msg,
+                        members=[r for r in results if isinstance(r, PreparedMessage)]
+                    ))
+                    raise result
+        
+        members = []
+        for msg, result in zip(msgs, results):
+            if isinstance(result, PreparedMessage):
+                members.append(result)
+                continue
+            logger.error(f"Download error in album {msg.media_group_id}: {result}")
+            await ContentDownloader._report_error(client, message, f"Download Error: {result}")
+        
+        prepared = PreparedMessage(
+            msgs[0].id,
+            msg=msgs[0],
+            msg_type="Album",
+            status_msg=status_msg,
+            members=members
+        )
+        if not members:
+            await ContentDownloader.discard(client, prepared)
+            return None
+        return prepared
+    
+    @staticmethod
+    async def deliver_album(
+        client: Client,
+        acc: Client,
+        message: Message,
+        prepared: PreparedMessage,
+        failover: bool = False
+    ) -> bool:
+        """Send a prepared media group with a single send_media_group, True if sent"""
+        target_chat = ContentDownloader.target_chat(message)
+        
+        if job_scheduler.is_cancelled(message.from_user.id):
+            await ContentDownloader.discard(client, prepared)
+            return False
+        
+        # A group needs at least two items
+        if len(prepared.members) == 1:
+            member = prepared.members[0]
+            member.status_msg, prepared.status_msg = prepared.status_msg, None
+            prepared.members = []
+            return await ContentDownloader.deliver(client, acc, message, member, failover=failover)
+        
+        try:
+            await prepared.status_msg.edit_text(
+                f'**Uploading album ({len(prepared.members)} files)...**'
+            )
+        except Exception as e:
+            logger.error(f"Error editing album status: {e}")
+        
+        sent = False
+        try:
+            started = time.monotonic()
+            media = [
+                await message_handler.get_input_media(member, acc)
+                for member in prepared.members
+            ]
+            await pacer.call(
+                client.name,
+                "send",
+                client.send_media_group,
+                target_chat,
+                media,
+                reply_to_message_id=message.id
+            )
+            sent = True
+            bot_metrics.record_transfer(
+                "upload",
+                "Album",
+                sum(ParallelUploader._size(member.media) for member in prepared.members),
+                time.monotonic() - started
+            )
+        except Exception as e:
+            source_error = ContentDownloader._source_error(prepared)
+            if failover and source_error is not None:
+                await ContentDownloader.discard(client, prepared)
+                raise source_error
+            logger.error(f"Album upload error: {e}")
+            if config.ERROR_MESSAGE:
+                await client.send_message(
+                    message.chat.id,
+                    f"Upload Error: {e}",
+                    reply_to_message_id=message.id
+                )
+        
+        await ContentDownloader.discard(client, prepared)
+        return sent
+    
+    @staticmethod
+    async def deliver(
+        client: Client,
+        acc: Client,
+        message: Message,
+        prepared: PreparedMessage,
+        failover: bool = False
+    ) -> bool:
+        """Upload a prepared message to the target chat, True if it was sent"""
+        msg = prepared.msg
+        msg_type = prepared.msg_type
+        
+        # Determine target chat
+        target_chat = ContentDownloader.target_chat(message)
+        
+        try:
+            # Handle text messages directly
+            if msg_type == "Text":
+                try:
+                    await pacer.call(
+                        client.name,
+                        "send",
+                        client.send_message,
+                        target_chat,
+                        msg.text,
+                        entities=msg.entities,
+                        reply_to_message_id=message.id,
+                        parse_mode=enums.ParseMode.HTML
+                    )
+                    return True
+                except Exception as e:
+                    if config.ERROR_MESSAGE:
+                        await client.send_message(
+                            message.chat.id,
+                            f"Error: {e}",
+                            reply_to_message_id=message.id
+                        )
+                return False
+            
+            # Check if batch is cancelled
+            if job_scheduler.is_cancelled(message.from_user.id):
+                await ContentDownloader.discard(client, prepared)
+                return False
+            
+            # Upload media
+            status_msg = prepared.status_msg
+            transfer = progress_tracker.track(client, status_msg, "up")
+            
+            sent = False
+            try:
+                await message_handler.send_message_by_type(
+                    client,
+                    target_chat,
+                    prepared.media,
+                    msg_type,
+                    msg,
+                    message,
+                    acc,
+                    progress=transfer.update
+                )
+                sent = True
+            except Exception as e:
+                progress_tracker.finish(transfer, e)
+                source_error = ContentDownloader._source_error(prepared)
+                if failover and source_error is not None:
+                    await ContentDownloader.discard(client, prepared)
+                    raise source_error
+                logger.error(f"Upload error: {e}")
+                if config.ERROR_MESSAGE:
+                    await client.send_message(
+                        message.chat.id,
+                        f"Upload Error: {e}",
+                        reply_to_message_id=message.id
+                    )
+            finally:
+                progress_tracker.finish(transfer)
+            
+            # Cleanup
+            await ContentDownloader.discard(client, prepared)
+            return sent
+            
+        except Exception as e:
+            if failover and e is ContentDownloader._source_error(prepared):
+                raise
+            logger.error(f"Error handling private message: {e}")
+            if config.ERROR_MESSAGE:
+                await client.send_message(
+                    message.chat.id,
+                    f"Error: {e}",
+                    reply_to_message_id=message.id
+                )
+            return False
+    
+    @staticmethod
+    async def _send_status(client: Client, message: Message, text: str) -> Message:
+        """Send a status message from the bot
+
+        Its errors come back as RuntimeError, so a bot-side FloodWait or
+        PeerIdInvalid is never mistaken for an error of the source account.
+        """
+        try:
+            return await pacer.call(
+                client.name,
+                "send",
+                client.send_message,
+                message.chat.id,
+                text,
+                reply_to_message_id=message.id
+            )
+        except Exception as e:
+            raise RuntimeError(f"Cannot send status message: {e}") from e
+    
+    @staticmethod
+    async def _report_error(client: Client, message: Message, text: str):
+        """Tell the user about a failed message, if enabled; never raises"""
+        if not config.ERROR_MESSAGE:
+            return
+        try:
+            await client.send_message(message.chat.id, text, reply_to_message_id=message.id)
+        except Exception as e:
+            logger.error(f"Error reporting to {message.chat.id}: {e}")
+    
+    @staticmethod
+    def _source_error(prepared: PreparedMessage) -> Optional[Exception]:
+        """Account-level error hit while streaming from the source account"""
+        for item in [prepared] + (prepared.members or []):
+            if isinstance(item.media, MediaStream) and isinstance(item.media.error, ACCOUNT_ERRORS):
+                return item.media.error
         return None
     
     @staticmethod
-    async def send_message_by_type(
+    async def discard(client: Client, prepared: PreparedMessage):
+        """Remove downloaded file and status message of a prepared message"""
+        for member in prepared.members or []:
+            await ContentDownloader.discard(client, member)
+        if not isinstance(prepared.media, MediaStream):
+            message_handler._cleanup_file(prepared.media)
+        prepared.media = None
+        if prepared.status_msg:
+            try:
+                await client.delete_messages(
+                    prepared.status_msg.chat.id, [prepared.status_msg.id]
+                )
+            except Exception as e:
+                logger.error(f"Error deleting status message: {e}")
+            prepared.status_msg = None
+
+content_downloader = ContentDownloader()
+
+# ============================================================================
+# BATCH PIPELINE
+# ============================================================================
+
+class MessageFetcher:
+    """Fetch message metadata in bulk through a shared LRU/TTL cache"""
+    
+    # Telegram returns at most 200 messages per request
+    CHUNK_SIZE = 200
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self._messages = TTLCache(maxsize, ttl)
+        # (chat, account name) pairs that proved read access to the chat
+        self._access = TTLCache(maxsize, ttl)
+    
+    @staticmethod
+    def _chat_key(chat_id) -> Union[int, str]:
+        return chat_id.lower().lstrip("@") if isinstance(chat_id, str) else chat_id
+    
+    async def get_message(self, acc: Client, chat_id, msg_id: int) -> Optional[Message]:
+        messages = await self.get_messages(acc, chat_id, [msg_id])
+        return messages[0] if messages else None
+    
+    async def get_messages(self, acc: Client, chat_id, msg_ids: List[int]) -> List[Message]:
+        """Fetch msg_ids in as few round trips as possible, preserving order"""
+        chat_key = self._chat_key(chat_id)
+        # Cached messages are only shared with accounts that can read the chat
+        trusted = self._access.get((chat_key, acc.name), False) is True
+        
+        found: Dict[int, Message] = {}
+        missing: List[int] = []
+        for msg_id in msg_ids:
+            # Media carries the fetching account's file reference and client,
+            # so it is only reused by that account; plain messages are shared
+            cached = self._messages.get((chat_key, msg_id, acc.name))
+            if cached is TTLCache.MISSING and trusted:
+                cached = self._messages.get((chat_key, msg_id))
+            if cached is TTLCache.MISSING:
+                missing.append(msg_id)
+            else:
+                found[msg_id] = cached
+        
+        for start in range(0, len(missing), self.CHUNK_SIZE):
+            chunk = missing[start:start + self.CHUNK_SIZE]
+            result = await pacer.call(
+                acc.name,
+                "get_messages",
+                acc.get_messages,
+                chat_id,
+                chunk,
+                retry=not account_pool.owns(acc)
+            )
+            for msg in (result if isinstance(result, list) else [result]):
+                if msg is None:
+                    continue
+                found[msg.id] = msg
+                # Empty ids may be posted later, so they are never cached
+                if msg.empty:
+                    continue
+                if msg.media:
+                    self._messages.set((chat_key, msg.id, acc.name), msg)
+                else:
+                    self._messages.set((chat_key, msg.id), msg)
+                self._access.set((chat_key, acc.name), True)
+        
+        return [found[msg_id] for msg_id in msg_ids if msg_id in found]
+    
+    async def refresh(self, acc: Client, msg: Message) -> Message:
+        """Fetch msg again for a new file reference, dropping the cached copy"""
+        for chat_id in (msg.chat.id, msg.chat.username):
+            if chat_id:
+                self._messages.pop((self._chat_key(chat_id), msg.id, acc.name))
+        fresh = await pacer.call(
+            acc.name,
+            "get_messages",
+            acc.get_messages,
+            msg.chat.id,
+            msg.id,
+            retry=not account_pool.owns(acc)
+        )
+        if fresh and not fresh.empty and fresh.media:
+            self._messages.set((self._chat_key(msg.chat.id), msg.id, acc.name), fresh)
+        return fresh
+    
+    def stats(self) -> Dict[str, Any]:
+        return self._messages.stats()
+
+message_fetcher = MessageFetcher(config.MESSAGE_CACHE_SIZE, config.MESSAGE_CACHE_TTL)
+
+
+class BatchPipeline:
+    """Download upcoming messages while the current one uploads"""
+    
+    _DONE = object()
+    
+    # Message types Telegram accepts in a media group
+    ALBUM_TYPES = ("Photo", "Video", "Document", "Audio")
+    # ForwardMessages takes at most 100 ids
+    BULK_SIZE = 100
+    
+    def __init__(
+        self,
         client: Client,
-        chat_id: int,
-        file_path: str,
-        msg_type: str,
-        msg: Message,
+        acc: Client,
         message: Message,
-        acc: Client
+        depth: int,
+        on_delivered: Optional[Callable[[int], Awaitable[None]]] = None,
+        failover: bool = False
     ):
-        """Send message based on type"""
-        caption = msg.caption if hasattr(msg, 'caption') else None
-        reply_to = message.id
+        self.client = client
+        self.acc = acc
+        self.message = message
+        self.depth = max(1, depth)
+        self.on_delivered = on_delivered
+        # Raise account-level errors so the caller can switch accounts
+        self.failover = failover
+    
+    def _cancelled(self) -> bool:
+        return job_scheduler.is_cancelled(self.message.from_user.id)
+    
+    async def run(self, source, msg_ids, public: bool = False):
+        """Process msg_ids from source in order with bounded prefetch"""
+        # At most `depth` prepared messages wait on disk for upload
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.depth)
+        producer = asyncio.create_task(self._produce(queue, source, msg_ids, public))
         
         try:
-            if msg_type == "Text":
-                await client.send_message(
-                    chat_id, 
-                    msg.text, 
-                    entities=msg.entities,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML
-                )
-            
-            elif msg_type == "Document":
-                thumb = await MessageHandler._get_thumb(acc, msg.document)
-                await client.send_document(
-                    chat_id, 
-                    file_path,
-                    thumb=thumb,
-                    caption=caption,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML,
-                    progress=lambda c, t: progress_tracker.write_progress(message.id, "up", c, t)
-                )
-                MessageHandler._cleanup_file(thumb)
-            
-            elif msg_type == "Video":
-                thumb = await MessageHandler._get_thumb(acc, msg.video)
-                await client.send_video(
-                    chat_id, 
-                    file_path,
-                    duration=msg.video.duration,
-                    width=msg.video.width,
-                    height=msg.video.height,
-                    thumb=thumb,
-                    caption=caption,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML,
-                    progress=lambda c, t: progress_tracker.write_progress(message.id, "up", c, t)
-                )
-                MessageHandler._cleanup_file(thumb)
-            
-            elif msg_type == "Audio":
-                thumb = await MessageHandler._get_thumb(acc, msg.audio)
-                await client.send_audio(
-                    chat_id, 
-                    file_path,
-                    thumb=thumb,
-                    caption=caption,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML,
-                    progress=lambda c, t: progress_tracker.write_progress(message.id, "up", c, t)
-                )
-                MessageHandler._cleanup_file(thumb)
-            
-            elif msg_type == "Photo":
-                await client.send_photo(
-                    chat_id, 
-                    file_path,
-                    caption=caption,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML
-                )
+            while True:
+                item = await queue.get()
+                if item is self._DONE:
+                    break
+                if isinstance(item, UsernameNotOccupied):
+                    await self.message.reply("The username is not occupied by anyone")
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if self._cancelled():
+                    await content_downloader.discard(self.client, item)
+                    continue
+                
+                delivered = False
+                try:
+                    if item.msg_type == "Text":
+                        delivered = await self._deliver(source, item)
+                    else:
+                        async with job_scheduler.transfer(self.message.from_user.id):
+                            delivered = await self._deliver(source, item)
+                except Exception as e:
+                    if self.failover and isinstance(e, ACCOUNT_ERRORS):
+                        # Not checkpointed: the next account starts from this item
+                        raise
+                    logger.error(f"Error processing message {item.msg_id}: {e}")
+                    if config.ERROR_MESSAGE:
+                        await self.message.reply(f"Error: {e}")
+                
+                # Only delivered items move the checkpoint
+                if delivered and self.on_delivered:
+                    last_id = max([m.msg_id for m in item.members or []] + [item.msg_id])
+                    await self.on_delivered(last_id)
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+            # Drop anything downloaded ahead but never delivered
+            while not queue.empty():
+                item = queue.get_nowait()
+                if isinstance(item, PreparedMessage):
+                    await content_downloader.discard(self.client, item)
+    
+    async def _produce(self, queue: asyncio.Queue, source, msg_ids, public: bool):
+        """Prepare messages in order, blocking when the queue is full"""
+        try:
+            album: List[Tuple[Message, bool]] = []
+            bulk: List[Message] = []
+            async for msg_id, msg, copyable in self._fetch(source, msg_ids, public):
+                if self._cancelled():
+                    break
+                
+                if msg is None or msg.empty:
+                    logger.warning(f"Skipping empty message: {source}/{msg_id}")
+                    continue
+                
+                # Runs of copyable messages, albums included, go out in bulk;
+                # types we cannot download (polls, video notes...) still copy
+                if copyable:
+                    if album:
+                        await self._prepare_album(queue, source, album)
+                        album = []
+                    if len(bulk) == self.BULK_SIZE:
+                        bulk = await self._flush_bulk(queue, source, bulk, msg)
+                    bulk.append(msg)
+                    continue
+                if bulk:
+                    await self._flush_bulk(queue, source, bulk)
+                    bulk = []
+                
+                # Skip unsupported ids without spending an RPC on them
+                if not message_handler.get_message_type(msg):
+                    logger.warning(f"Skipping unsupported message: {source}/{msg_id}")
+                    continue
+                
+                # Collect consecutive members of the same media group
+                if album and msg.media_group_id != album[0][0].media_group_id:
+                    await self._prepare_album(queue, source, album)
+                    album = []
+                if msg.media_group_id and message_handler.get_message_type(msg) in self.ALBUM_TYPES:
+                    album.append((msg, copyable))
+                    continue
+                
+                await self._prepare_single(queue, source, msg, copyable)
             
-            elif msg_type == "Animation":
-                await client.send_animation(
-                    chat_id, 
-                    file_path,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML
+            if bulk and not self._cancelled():
+                await self._flush_bulk(queue, source, bulk)
+            if album and not self._cancelled():
+                await self._prepare_album(queue, source, album)
+        except UsernameNotOccupied as e:
+            await queue.put(e)
+            return
+        except ACCOUNT_ERRORS as e:
+            if not self.failover:
+                logger.error(f"Batch producer failed: {e}")
+                if config.ERROR_MESSAGE:
+                    await self.message.reply(f"Error: {e}")
+                await queue.put(self._DONE)
+                return
+            # Everything queued before the error is still delivered first
+            await queue.put(e)
+            return
+        except Exception as e:
+            logger.error(f"Batch producer failed: {e}")
+            if config.ERROR_MESSAGE:
+                await self.message.reply(f"Error: {e}")
+        await queue.put(self._DONE)
+    
+    async def _flush_bulk(
+        self,
+        queue: asyncio.Queue,
+        source,
+        bulk: List[Message],
+        next_msg: Optional[Message] = None
+    ) -> List[Message]:
+        """Queue bulk as one forward, returning messages held back for the next"""
+        keep = 0
+        group = bulk[-1].media_group_id
+        if next_msg is not None and group and next_msg.media_group_id == group:
+            # Don't split an album across two calls
+            while keep < len(bulk) and bulk[-1 - keep].media_group_id == group:
+                keep += 1
+            if keep == len(bulk):
+                keep = 0
+        batch, rest = bulk[:len(bulk) - keep], bulk[len(bulk) - keep:]
+        
+        if len(batch) == 1:
+            # A lone message keeps copy_message and its reply
+            await self._prepare_single(queue, source, batch[0], True)
+        else:
+            members = [PreparedMessage(msg.id, msg=msg, copy_from=msg) for msg in batch]
+            await queue.put(PreparedMessage(
+                batch[0].id,
+                msg=batch[0],
+                copy_from=batch[0],
+                members=members,
+                bulk=True
+            ))
+        return rest
+    
+    async def _prepare_single(self, queue: asyncio.Queue, source, msg: Message, copyable: bool):
+        if copyable:
+            await queue.put(PreparedMessage(msg.id, msg=msg, copy_from=msg))
+            return
+        
+        if message_handler.get_message_type(msg) == "Text":
+            prepared = await content_downloader.prepare_private_message(
+                self.client, self.acc, self.message, source, msg.id, msg=msg,
+                failover=self.failover
+            )
+        else:
+            async with job_scheduler.transfer(self.message.from_user.id):
+                prepared = await content_downloader.prepare_private_message(
+                    self.client, self.acc, self.message, source, msg.id, msg=msg,
+                    failover=self.failover
                 )
+        if prepared:
+            await queue.put(prepared)
+    
+    async def _prepare_album(self, queue: asyncio.Queue, source, album: List[Tuple[Message, bool]]):
+        if len(album) == 1:
+            await self._prepare_single(queue, source, *album[0])
+            return
+        
+        # Copyable albums never get here, they go out with the bulk copies
+        msgs = [msg for msg, _ in album]
+        async with job_scheduler.transfer(self.message.from_user.id):
+            prepared = await content_downloader.prepare_album(
+                self.client, self.acc, self.message, msgs, failover=self.failover
+            )
+        if prepared:
+            await queue.put(prepared)
+    
+    async def _fetch(self, source, msg_ids, public: bool):
+        """Yield (msg_id, message, copyable) using multi-id get_messages"""
+        chunk_size = MessageFetcher.CHUNK_SIZE
+        
+        # Slicing keeps a range lazy, huge ranges are never materialised
+        for start in range(0, len(msg_ids), chunk_size):
+            chunk = list(msg_ids[start:start + chunk_size])
+            copyable: Dict[int, Message] = {}
             
-            elif msg_type == "Sticker":
-                await client.send_sticker(
-                    chat_id, 
-                    file_path,
-                    reply_to_message_id=reply_to
-                )
+            if public:
+                # Bot can copy unprotected public posts without downloading
+                try:
+                    for msg in await message_fetcher.get_messages(self.client, source, chunk):
+                        if not msg.empty and not msg.has_protected_content:
+                            copyable[msg.id] = msg
+                except UsernameNotOccupied:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Bot cannot read {source}: {e}")
             
-            elif msg_type == "Voice":
-                await client.send_voice(
-                    chat_id, 
-                    file_path,
-                    caption=caption,
-                    reply_to_message_id=reply_to,
-                    parse_mode=enums.ParseMode.HTML,
-                    progress=lambda c, t: progress_tracker.write_progress(message.id, "up", c, t)
-                )
+            rest = [msg_id for msg_id in chunk if msg_id not in copyable]
+            fetched = await message_fetcher.get_messages(self.acc, source, rest) if rest else []
+            by_id = {msg.id: msg for msg in fetched if msg}
             
+            for msg_id in chunk:
+                if msg_id in copyable:
+                    yield msg_id, copyable[msg_id], True
+                else:
+                    yield msg_id, by_id.get(msg_id), False
+    
+    async def _deliver(self, source, prepared: PreparedMessage) -> bool:
+        """Send one queued item, True if all of it arrived"""
+        if prepared.bulk:
+            return await self._deliver_bulk(source, prepared)
+        
+        if prepared.members is not None and prepared.copy_from is None:
+            return await content_downloader.deliver_album(
+                self.client, self.acc, self.message, prepared, failover=self.failover
+            )
+        
+        if prepared.copy_from is None:
+            return await content_downloader.deliver(
+                self.client, self.acc, self.message, prepared, failover=self.failover
+            )
+        
+        try:
+            await pacer.call(
+                self.client.name,
+                "send",
+                self.client.copy_message,
+                self.message.chat.id,
+                prepared.copy_from.chat.id,
+                prepared.copy_from.id,
+                reply_to_message_id=self.message.id
+            )
+            return True
+        except Exception:
+            return await content_downloader.handle_private_message(
+                self.client, self.acc, self.message, source, prepared.msg_id,
+                failover=self.failover
+            )
+
+    async def _deliver_bulk(self, source, prepared: PreparedMessage) -> bool:
+        """Copy a run of public messages in order with a single ForwardMessages"""
+        ids = [member.msg_id for member in prepared.members]
+        try:
+            # drop_author makes the copies look like copy_message output;
+            # ForwardMessages cannot reply, so they are not threaded under the request
+            rpc = raw.functions.messages.ForwardMessages(
+                from_peer=await self.client.resolve_peer(prepared.copy_from.chat.id),
+                id=ids,
+                random_id=[self.client.rnd_id() for _ in ids],
+                to_peer=await self.client.resolve_peer(self.message.chat.id),
+                drop_author=True
+            )
+            await pacer.call(self.client.name, "send", self.client.invoke, rpc)
             return True
+        except Exception as e:
+            logger.warning(f"Bulk copy of {len(ids)} messages failed, copying one by one: {e}")
+        
+        delivered = True
+        for member in prepared.members:
+            delivered = await self._deliver(source, member) and delivered
+        return delivered
+
+# ============================================================================
+# BROADCAST ENGINE
+# ============================================================================
+
+class BroadcastEngine:
+    """Concurrent, rate-limited broadcast with Mongo checkpoints"""
+    
+    CHUNK_SIZE = 200
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = 5
+    
+    # Errors that say nothing about the user, only about our connection
+    CONNECTION_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
+    
+    # Delivery results that mean the user is gone for good
+    DEAD = ('blocked', 'deleted', 'invalid')
+    
+    def __init__(self, concurrency: int, rate: float, status_interval: float):
+        self.concurrency = max(1, concurrency)
+        self.status_interval = status_interval
+        self._bucket = TokenBucket(rate)
+        self._gate = asyncio.Event()
+        self._gate.set()
+        self._paused_until = 0.0
+        self._unpause_task: Optional[asyncio.Task] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._running: Dict[str, Dict[str, Any]] = {}
+    
+    @staticmethod
+    def new_broadcast(
+        source: Message,
+        status: Message,
+        total: int,
+        cohort: Cohort
+    ) -> Dict[str, Any]:
+        """Create broadcast document"""
+        return {
+            '_id': f"{source.chat.id}:{source.id}:{int(time.time())}",
+            'source_chat': source.chat.id,
+            'source_msg': source.id,
+            'status_chat': status.chat.id,
+            'status_msg': status.id,
+            'status': 'running',
+            'cohort': cohort.to_dict(),
+            'last_id': None,
+            'total': total,
+            'done': 0,
+            'success': 0,
+            'blocked': 0,
+            'deleted': 0,
+            'failed': 0,
+            'started_at': datetime.now()
+        }
+    
+    async def start(self, client: Client, broadcast: Dict[str, Any]):
+        """Persist broadcast and run it in the background"""
+        await db.save_broadcast(broadcast)
+        self._spawn(client, broadcast)
+    
+    async def resume_all(self, client: Client):
+        """Continue broadcasts interrupted by a restart"""
+        for broadcast in await db.get_unfinished_broadcasts():
+            if broadcast['_id'] not in self._tasks:
+                logger.info(f"Resuming broadcast {broadcast['_id']} after user {broadcast['last_id']}")
+                self._spawn(client, broadcast)
+    
+    def _spawn(self, client: Client, broadcast: Dict[str, Any]):
+        task = asyncio.create_task(self._run(client, broadcast))
+        self._tasks[broadcast['_id']] = task
+        self._running[broadcast['_id']] = broadcast
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast['_id'], None))
+        task.add_done_callback(lambda _: self._running.pop(broadcast['_id'], None))
+    
+    async def shutdown(self):
+        """Cancel running broadcasts; the current page is not checkpointed and is resent on start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def progress(self) -> Dict[Tuple[str, str], int]:
+        """User counts of running broadcasts by state"""
+        return {
+            (broadcast_id, state): broadcast[state]
+            for broadcast_id, broadcast in self._running.items()
+            for state in ('total', 'done', 'success', 'blocked', 'deleted', 'failed')
+        }
+    
+    async def _run(self, client: Client, broadcast: Dict[str, Any]):
+        start_time = time.monotonic()
+        last_status = 0.0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        cohort = Cohort.from_dict(broadcast.get('cohort'))
+        
+        async def deliver(user_id: int) -> str:
+            async with semaphore:
+                return await self._send(client, broadcast, user_id)
+        
+        try:
+            while True:
+                user_ids = await db.get_user_ids(broadcast['last_id'], self.CHUNK_SIZE, cohort)
+                if user_ids is None:
+                    # Left 'running' so the next start resumes it
+                    raise RuntimeError("user query failed")
+                if not user_ids:
+                    break
+                
+                targets = [user_id for user_id in user_ids if cohort.includes(user_id)]
+                results = await asyncio.gather(*(deliver(user_id) for user_id in targets))
+                if 'unreachable' in results:
+                    # Left 'running' without a checkpoint, the page is resent on start
+                    raise RuntimeError("lost connection to Telegram")
+                
+                dead = []
+                for user_id, result in zip(targets, results):
+                    broadcast['done'] += 1
+                    if result == 'success':
+                        broadcast['success'] += 1
+                    elif result == 'blocked':
+                        broadcast['blocked'] += 1
+                    elif result == 'deleted':
+                        broadcast['deleted'] += 1
+                    else:
+                        broadcast['failed'] += 1
+                    if result in self.DEAD:
+                        dead.append(user_id)
+                await db.delete_users(dead)
+                
+                # Checkpoint: everything up to last_id has been attempted
+                broadcast['last_id'] = user_ids[-1]
+                await db.save_broadcast(broadcast)
+                
+                if time.monotonic() - last_status >= self.status_interval:
+                    last_status = time.monotonic()
+                    await self._edit_status(client, broadcast, "Broadcast in progress:\n")
+            
+            broadcast['status'] = 'completed'
+            broadcast['finished_at'] = datetime.now()
+            await db.save_broadcast(broadcast)
             
+            time_taken = timedelta(seconds=int(time.monotonic() - start_time))
+            await self._edit_status(
+                client,
+                broadcast,
+                f"Broadcast Completed:\nCompleted in {time_taken} seconds.\n"
+            )
         except Exception as e:
-            logger.error(f"Error sending {msg_type}: {e}")
-            raise
+            logger.error(f"Broadcast {broadcast['_id']} failed: {e}")
+            logger.error(traceback.format_exc())
+    
+    async def _send(self, client: Client, broadcast: Dict[str, Any], user_id: int) -> str:
+        """Copy broadcast message to one user, return the outcome"""
+        result = 'failed'
+        for _ in range(self.MAX_ATTEMPTS):
+            await self._gate.wait()
+            await self._bucket.acquire()
+            try:
+                await client.copy_message(user_id, broadcast['source_chat'], broadcast['source_msg'])
+                return 'success'
+            except FloodWait as e:
+                # One FloodWait holds back every worker, not just this one
+                self._pause(e.value)
+            except InputUserDeactivated:
+                return 'deleted'
+            except UserIsBlocked:
+                return 'blocked'
+            except PeerIdInvalid:
+                return 'invalid'
+            except self.CONNECTION_ERRORS as e:
+                logger.warning(f"Broadcast to user {user_id} hit a connection error: {e}")
+                result = 'unreachable'
+                await asyncio.sleep(self.RETRY_DELAY)
+            except Exception as e:
+                logger.error(f"Broadcast error for user {user_id}: {e}")
+                return 'failed'
+        return result
+    
+    def _pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until <= self._paused_until:
+            return
+        self._paused_until = until
+        self._gate.clear()
+        logger.warning(f"Broadcast paused for {seconds}s by FloodWait")
+        if self._unpause_task is None or self._unpause_task.done():
+            self._unpause_task = asyncio.create_task(self._unpause())
+    
+    async def _unpause(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        self._gate.set()
+    
+    @staticmethod
+    async def _edit_status(client: Client, broadcast: Dict[str, Any], header: str):
+        try:
+            await client.edit_message_text(
+                broadcast['status_chat'],
+                broadcast['status_msg'],
+                f"{header}\n"
+                f"Audience: {Cohort.from_dict(broadcast.get('cohort')).describe()}\n"
+                f"Total Users: {broadcast['total']}\n"
+                f"Completed: {broadcast['done']} / {broadcast['total']}\n"
+                f"Success: {broadcast['success']}\n"
+                f"Blocked: {broadcast['blocked']}\n"
+                f"Deleted: {broadcast['deleted']}\n"
+                f"Failed: {broadcast['failed']}"
+            )
+        except Exception as e:
+            logger.error(f"Error editing broadcast status: {e}")
+
+broadcast_engine = BroadcastEngine(
+    config.BROADCAST_CONCURRENCY,
+    config.BROADCAST_RATE,
+    config.BROADCAST_STATUS_INTERVAL
+)
+
+# ============================================================================
+# ACCOUNT POOL
+# ============================================================================
+
+# Account can no longer be used at all
+DEAD_ACCOUNT_ERRORS = (
+    AuthKeyUnregistered,
+    AuthKeyInvalid,
+    SessionRevoked,
+    UserDeactivated,
+    UserDeactivatedBan
+)
+# Account cannot read a particular chat
+NO_ACCESS_ERRORS = (ChannelPrivate, ChannelInvalid, PeerIdInvalid)
+ACCOUNT_ERRORS = (FloodWait,) + DEAD_ACCOUNT_ERRORS + NO_ACCESS_ERRORS
+
+
+@dataclass
+class WorkerAccount:
+    """Health and load of one string-session account"""
+    client: Client
+    active: int = 0
+    served: int = 0
+    healthy: bool = True
+    flood_until: float = 0.0
+    flood_waits: int = 0
+    # chat key -> monotonic time the account could / could not read it
+    readable: Dict[Any, float] = field(default_factory=dict)
+    unreadable: Dict[Any, float] = field(default_factory=dict)
+    
+    @property
+    def name(self) -> str:
+        return self.client.name
+    
+    def ready(self, now: float) -> bool:
+        return (
+            self.healthy
+            and self.flood_until <= now
+            and not pacer.blocked(self.name, "get_messages")
+        )
+
+
+class AccountPool:
+    """Spread non-login downloads over several user accounts"""
+    
+    # How long a failed read keeps an account away from that chat
+    NO_ACCESS_TTL = 600
+    
+    def __init__(self):
+        self._accounts: List[WorkerAccount] = []
+        self._cond = asyncio.Condition()
+    
+    def add(self, client: Client):
+        self._accounts.append(WorkerAccount(client))
     
-    @staticmethod
-    async def _get_thumb(acc: Client, media) -> Optional[str]:
-        """Get thumbnail for media"""
-        try:
-            if hasattr(media, 'thumbs') and media.thumbs:
-                return await acc.download_media(media.thumbs[0].file_id)
-        except Exception as e:
-            logger.error(f"Error getting thumbnail: {e}")
+    @property
+    def available(self) -> bool:
+        """At least one account is still usable"""
+        return any(account.healthy for account in self._accounts)
+    
+    @property
+    def clients(self) -> List[Client]:
+        return [account.client for account in self._accounts if account.healthy]
+    
+    def owns(self, client: Client) -> bool:
+        """Whether client is a pool account that can be failed over"""
+        return self._find(client) is not None
+    
+    def _find(self, client: Client) -> Optional[WorkerAccount]:
+        for account in self._accounts:
+            if account.client is client:
+                return account
         return None
     
-    @staticmethod
-    def _cleanup_file(file_path: Optional[str]):
-        """Clean up temporary file"""
-        if file_path and os.path.exists(file_path):
+    def _can_read(self, account: WorkerAccount, chat_key, now: float) -> bool:
+        failed_at = account.unreadable.get(chat_key)
+        if failed_at is None:
+            return True
+        if now - failed_at > self.NO_ACCESS_TTL:
+            del account.unreadable[chat_key]
+            return True
+        return False
+    
+    async def acquire(self, chat_id) -> Client:
+        """Least loaded healthy account, preferring ones known to read chat_id"""
+        chat_key = MessageFetcher._chat_key(chat_id)
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                candidates = [
+                    account for account in self._accounts
+                    if account.healthy and self._can_read(account, chat_key, now)
+                ]
+                if not candidates:
+                    if not self.available:
+                        raise LookupError("No Working String Session Left")
+                    raise LookupError("None Of The Accounts Can Access This Chat")
+                
+                ready = [account for account in candidates if account.ready(now)]
+                if ready:
+                    account = min(
+                        ready,
+                        key=lambda a: (chat_key not in a.readable, a.active, a.served)
+                    )
+                    account.active += 1
+                    account.served += 1
+                    return account.client
+                
+                # Everyone is rate-limited: sleep until the first one frees up
+                delay = max(1.0, min(account.flood_until for account in candidates) - now)
+                try:
+                    await asyncio.wait_for(self._cond.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def release(self, client: Client):
+        account = self._find(client)
+        if account:
+            account.active = max(0, account.active - 1)
+        async with self._cond:
+            self._cond.notify_all()
+    
+    def report_flood(self, client: Client, seconds: float):
+        account = self._find(client)
+        if account:
+            account.flood_waits += 1
+            account.flood_until = max(account.flood_until, time.monotonic() + seconds)
+            logger.warning(f"Account {account.name} rate-limited for {seconds}s")
+    
+    def report_dead(self, client: Client, error: Exception):
+        account = self._find(client)
+        if account and account.healthy:
+            account.healthy = False
+            logger.error(f"Account {account.name} disabled: {error}")
+            asyncio.create_task(media_sessions.close(client))
+    
+    def report_access(self, client: Client, chat_id, ok: bool):
+        account = self._find(client)
+        if account is None:
+            return
+        chat_key = MessageFetcher._chat_key(chat_id)
+        if ok:
+            account.readable[chat_key] = time.monotonic()
+            account.unreadable.pop(chat_key, None)
+        else:
+            account.unreadable[chat_key] = time.monotonic()
+            account.readable.pop(chat_key, None)
+    
+    async def join_chat(self, link: str) -> List[Tuple[str, Optional[Exception]]]:
+        """Join link on every healthy account, (name, error) per account"""
+        results = []
+        for account in self._accounts:
+            if not account.healthy:
+                continue
             try:
-                os.remove(file_path)
+                await account.client.join_chat(link)
+                # Membership changed, forget earlier failed reads
+                account.unreadable.clear()
+                results.append((account.name, None))
+            except DEAD_ACCOUNT_ERRORS as e:
+                self.report_dead(account.client, e)
+                results.append((account.name, e))
             except Exception as e:
-                logger.error(f"Error removing file {file_path}: {e}")
+                results.append((account.name, e))
+        return results
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                'name': account.name,
+                'healthy': account.healthy,
+                'active': account.active,
+                'served': account.served,
+                'flood_waits': account.flood_waits,
+                'flood_left': max(0.0, account.flood_until - now)
+            }
+            for account in self._accounts
+        ]
+    
+    async def close_all(self):
+        """Stop every connected account, safe to call more than once"""
+        for account in self._accounts:
+            if not account.client.is_connected:
+                continue
+            try:
+                await account.client.stop()
+            except Exception as e:
+                logger.error(f"Error stopping account {account.name}: {e}")
 
-message_handler = MessageHandler()
+account_pool = AccountPool()
+
+async def initialize_user_client():
+    """Start every configured string session for non-login mode"""
+    if config.LOGIN_SYSTEM:
+        return
+    
+    sessions = [config.STRING_SESSION] if config.STRING_SESSION else []
+    sessions += [s for s in config.STRING_SESSIONS if s not in sessions]
+    
+    for index, session in enumerate(sessions):
+        name = "TechVJ" if index == 0 else f"TechVJ{index + 1}"
+        try:
+            client = PacedClient(
+                name,
+                api_id=config.API_ID,
+                api_hash=config.API_HASH,
+                session_string=session
+            )
+            await client.start()
+            account_pool.add(client)
+            logger.info(f"User client {name} initialized successfully")
+        except Exception as e:
+            logger.error(f"Failed to initialize user client {name}: {e}")
 
 # ============================================================================
-# CONTENT DOWNLOADER CLASS
+# USER SESSION POOL
 # ============================================================================
 
-class ContentDownloader:
-    """Handle content downloading and forwarding"""
+@dataclass
+class PooledSession:
+    """Connected user client kept warm between requests"""
+    client: Client
+    session_string: str
+    last_used: float = field(default_factory=time.monotonic)
+    in_use: int = 0
+
+
+class SessionPool:
+    """Keep per-user clients connected across batches"""
+    
+    REAP_INTERVAL = 60
+    
+    def __init__(self, max_size: int, idle_timeout: int):
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self._sessions: "OrderedDict[int, PooledSession]" = OrderedDict()
+        self._open = 0
+        self._cond = asyncio.Condition()
+        self._reaper: Optional[asyncio.Task] = None
+    
+    async def acquire(
+        self,
+        user_id: int,
+        session_string: str,
+        api_id: int,
+        api_hash: str
+    ) -> Client:
+        """Get a connected client for user, reusing a warm one if possible"""
+        self._ensure_reaper()
+        
+        entry = self._sessions.get(user_id)
+        if entry and entry.session_string == session_string and entry.client.is_connected:
+            self.hits += 1
+            entry.in_use += 1
+            entry.last_used = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            return entry.client
+        
+        self.misses += 1
+        if entry:
+            # Stale session (new login or dropped connection)
+            await self.invalidate(user_id)
+        
+        # Reserve a slot under the global cap, evicting idle sessions if needed
+        async with self._cond:
+            while self._open >= self.max_size:
+                victim = self._pop_lru_idle()
+                if victim is not None:
+                    # Slot is freed now; disconnect happens outside the lock
+                    self._open -= 1
+                    asyncio.create_task(self._disconnect(victim))
+                    continue
+                await self._cond.wait()
+            self._open += 1
+        
+        client = PacedClient(
+            f"saverestricted_{user_id}",
+            session_string=session_string,
+            api_hash=api_hash,
+            api_id=api_id
+        )
+        try:
+            await client.connect()
+        except Exception:
+            await self._release_slot()
+            raise
+        
+        # Another request for the same user may have connected meanwhile
+        existing = self._sessions.get(user_id)
+        if existing and existing.session_string == session_string and existing.client.is_connected:
+            await self._close(client)
+            existing.in_use += 1
+            existing.last_used = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            return existing.client
+        if existing:
+            await self.invalidate(user_id)
+        
+        self._sessions[user_id] = PooledSession(client, session_string, in_use=1)
+        return client
+    
+    async def release(self, user_id: int, client: Client):
+        """Return client to the pool after a batch"""
+        entry = self._sessions.get(user_id)
+        if entry and entry.client is client:
+            entry.in_use = max(0, entry.in_use - 1)
+            entry.last_used = time.monotonic()
+            async with self._cond:
+                self._cond.notify()
+        else:
+            # Invalidated while in use
+            await self._close(client)
+    
+    async def invalidate(self, user_id: int):
+        """Drop user's pooled client (e.g. after /logout)"""
+        entry = self._sessions.pop(user_id, None)
+        if entry and entry.in_use == 0:
+            await self._close(entry.client)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Pool counters"""
+        lookups = self.hits + self.misses
+        return {
+            'open': self._open,
+            'pooled': len(self._sessions),
+            'in_use': sum(1 for e in self._sessions.values() if e.in_use),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0
+        }
+    
+    async def close_all(self):
+        """Disconnect every idle pooled client"""
+        for user_id in list(self._sessions):
+            await self.invalidate(user_id)
+    
+    def _pop_lru_idle(self) -> Optional[Client]:
+        """Remove least recently used idle session from the pool"""
+        for user_id, entry in self._sessions.items():
+            if entry.in_use == 0:
+                del self._sessions[user_id]
+                return entry.client
+        return None
     
     @staticmethod
-    async def handle_private_message(
-        client: Client,
-        acc: Client,
-        message: Message,
-        chat_id: int,
-        msg_id: int
-    ):
-        """Handle private channel message"""
+    async def _disconnect(client: Client):
+        await media_sessions.close(client)
         try:
-            # Get the message
-            msg: Message = await acc.get_messages(chat_id, msg_id)
-            
-            if msg.empty:
-                logger.warning(f"Empty message: {chat_id}/{msg_id}")
-                return
-            
-            # Determine message type
-            msg_type = message_handler.get_message_type(msg)
-            if not msg_type:
-                logger.warning(f"Unknown message type: {chat_id}/{msg_id}")
-                return
-            
-            # Determine target chat
-            target_chat = int(config.CHANNEL_ID) if config.CHANNEL_ID else message.chat.id
-            
-            # Check if batch is cancelled
-            if batch_manager.is_cancelled(message.from_user.id):
-                return
-            
-            # Handle text messages directly
-            if msg_type == "Text":
-                try:
-                    await client.send_message(
-                        target_chat,
-                        msg.text,
-                        entities=msg.entities,
-                        reply_to_message_id=message.id,
-                        parse_mode=enums.ParseMode.HTML
-                    )
-                    return
-                except Exception as e:
-                    if config.ERROR_MESSAGE:
-                        await client.send_message(
-                            message.chat.id,
-                            f"Error: {e}",
-                            reply_to_message_id=message.id
-                        )
-                    return
-            
-            # Download media
-            status_msg = await client.send_message(
-                message.chat.id,
-                '**Downloading...**',
-                reply_to_message_id=message.id
-            )
-            
-            download_status_file = f'{message.id}downstatus.txt'
-            asyncio.create_task(
-                progress_tracker.monitor_download_progress(
-                    client, 
-                    download_status_file, 
-                    status_msg, 
-                    target_chat
-                )
-            )
-            
-            try:
-                file_path = await acc.download_media(
-                    msg,
-                    progress=lambda c, t: progress_tracker.write_progress(message.id, "down", c, t)
-                )
-                
-                if os.path.exists(download_status_file):
-                    os.remove(download_status_file)
-                    
-            except Exception as e:
-                logger.error(f"Download error: {e}")
-                if config.ERROR_MESSAGE:
-                    await client.send_message(
-                        message.chat.id,
-                        f"Download Error: {e}",
-                        reply_to_message_id=message.id
-                    )
-                await status_msg.delete()
-                return
-            
-            # Check if batch is cancelled
-            if batch_manager.is_cancelled(message.from_user.id):
-                message_handler._cleanup_file(file_path)
-                return
-            
-            # Upload media
-            upload_status_file = f'{message.id}upstatus.txt'
-            asyncio.create_task(
-                progress_tracker.monitor_upload_progress(
-                    client, 
-                    upload_status_file, 
-                    status_msg, 
-                    target_chat
-                )
-            )
-            
+            await client.disconnect()
+        except Exception as e:
+            logger.error(f"Error disconnecting user client: {e}")
+    
+    async def _close(self, client: Client):
+        """Disconnect client and free its slot"""
+        await self._disconnect(client)
+        await self._release_slot()
+    
+    async def _release_slot(self):
+        async with self._cond:
+            self._open = max(0, self._open - 1)
+            self._cond.notify()
+    
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_idle())
+    
+    async def _reap_idle(self):
+        """Periodically disconnect sessions idle past the timeout"""
+        while True:
+            await asyncio.sleep(self.REAP_INTERVAL)
             try:
-                await message_handler.send_message_by_type(
-                    client,
-                    target_chat,
-                    file_path,
-                    msg_type,
-                    msg,
-                    message,
-                    acc
-                )
+                cutoff = time.monotonic() - self.idle_timeout
+                expired = [
+                    user_id for user_id, entry in self._sessions.items()
+                    if entry.in_use == 0 and entry.last_used < cutoff
+                ]
+                for user_id in expired:
+                    await self.invalidate(user_id)
+                if expired:
+                    logger.info(f"Closed {len(expired)} idle user sessions")
             except Exception as e:
-                logger.error(f"Upload error: {e}")
-                if config.ERROR_MESSAGE:
-                    await client.send_message(
-                        message.chat.id,
-                        f"Upload Error: {e}",
-                        reply_to_message_id=message.id
-                    )
-            
-            # Cleanup
-            for file in [upload_status_file, file_path]:
-                message_handler._cleanup_file(file)
-            
-            await client.delete_messages(message.chat.id, [status_msg.id])
-            
-        except Exception as e:
-            logger.error(f"Error handling private message: {e}")
-            if config.ERROR_MESSAGE:
-                await client.send_message(
-                    message.chat.id,
-                    f"Error: {e}",
-                    reply_to_message_id=message.id
-                )
+                logger.error(f"Error reaping idle sessions: {e}")
 
-content_downloader = ContentDownloader()
+session_pool = SessionPool(config.MAX_USER_SESSIONS, config.SESSION_IDLE_TIMEOUT)
 
 # ============================================================================
-# USER CLIENT MANAGER
+# STATUS SERVER
 # ============================================================================
 
-TechVJUser: Optional[Client] = None
+class StatusServer:
+    """Minimal HTTP server on the bot's event loop for health and metrics
 
-def initialize_user_client():
-    """Initialize user client if string session is provided"""
-    global TechVJUser
+    Health and readiness are served on the public port, /metrics on a
+    separate (by default loopback) bind. Hosts that only route the public
+    port can set a metrics token to scrape /metrics there as well.
+    """
+    
+    READ_TIMEOUT = 10
+    METRICS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ready_timeout: float,
+        metrics_host: str,
+        metrics_port: int,
+        metrics_token: str = ""
+    ):
+        self.host = host
+        self.port = port
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_token = metrics_token
+        self.ready_timeout = ready_timeout
+        self.bot: Optional[Client] = None
+        self._servers: List[asyncio.AbstractServer] = []
+        # path -> handler returning (status, content type, body)
+        self.routes: Dict[str, Callable[[], Awaitable[Tuple[int, str, str]]]] = {
+            '/': self._home,
+            '/health': self._health,
+            '/ready': self._ready
+        }
+        self.metrics_routes: Dict[str, Callable[[], Awaitable[Tuple[int, str, str]]]] = {
+            '/metrics': self._metrics
+        }
+        if metrics_token:
+            self.routes['/metrics'] = self._metrics
+    
+    async def start(self):
+        binds = [
+            (self.host, self.port, self.routes),
+            (self.metrics_host, self.metrics_port, self.metrics_routes)
+        ]
+        for host, port, routes in binds:
+            if not port:
+                continue
+            server = await asyncio.start_server(
+                functools.partial(self._handle, routes), host, port
+            )
+            self._servers.append(server)
+            logger.info(f"Status server listening on {host}:{port} ({', '.join(routes)})")
+    
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers.clear()
+    
+    @staticmethod
+    async def _home() -> Tuple[int, str, str]:
+        return 200, "text/plain", "Bot is alive and running!"
+    
+    @staticmethod
+    async def _health() -> Tuple[int, str, str]:
+        # Answering at all proves the event loop is not stuck
+        return 200, "application/json", json.dumps({'status': 'ok'})
     
-    if config.STRING_SESSION and not config.LOGIN_SYSTEM:
+    async def _ready(self) -> Tuple[int, str, str]:
+        """Bot connected, Mongo reachable and (without login) a user client up"""
         try:
-            TechVJUser = Client(
-                "TechVJ",
-                api_id=config.API_ID,
-                api_hash=config.API_HASH,
-                session_string=config.STRING_SESSION
+            mongo = await asyncio.wait_for(db.ping(), self.ready_timeout)
+        except asyncio.TimeoutError:
+            mongo = False
+        
+        if config.LOGIN_SYSTEM:
+            user_client = True
+        else:
+            user_client = any(client.is_connected for client in account_pool.clients)
+        
+        checks = {
+            'bot': bool(self.bot and self.bot.is_connected and self.bot.me),
+            'mongo': mongo,
+            'user_client': user_client
+        }
+        ready = all(checks.values())
+        body = json.dumps({'ready': ready, 'checks': checks})
+        return (200 if ready else 503), "application/json", body
+    
+    def _authorized(self, authorization: str) -> bool:
+        """Bearer token check for /metrics on the public port"""
+        expected = f"Bearer {self.metrics_token}"
+        if not self.metrics_token:
+            return False
+        return hmac.compare_digest(authorization.encode(), expected.encode())
+    
+    @classmethod
+    async def _metrics(cls) -> Tuple[int, str, str]:
+        return 200, cls.METRICS_TYPE, bot_metrics.registry.render()
+    
+    async def _handle(
+        self,
+        routes: Dict[str, Callable[[], Awaitable[Tuple[int, str, str]]]],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter
+    ):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.READ_TIMEOUT)
+            # Only Authorization is needed, the rest is drained
+            authorization = ""
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.READ_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "authorization":
+                    authorization = value.strip()
+            
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+            handler = routes.get(path)
+            if handler is None:
+                status, content_type, body = 404, "text/plain", "Not Found\n"
+            elif routes is self.routes and path == '/metrics' and not self._authorized(authorization):
+                status, content_type, body = 401, "text/plain", "Unauthorized\n"
+            else:
+                status, content_type, body = await handler()
+            
+            payload = body.encode()
+            reason = {
+                200: "OK", 401: "Unauthorized", 404: "Not Found", 503: "Service Unavailable"
+            }.get(status, "OK")
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode() + payload
             )
-            TechVJUser.start()
-            logger.info("User client initialized successfully")
+            await writer.drain()
         except Exception as e:
-            logger.error(f"Failed to initialize user client: {e}")
-            TechVJUser = None
+            logger.error(f"Status server error: {e}")
+        finally:
+            writer.close()
+
+status_server = StatusServer(
+    config.HTTP_HOST,
+    config.HTTP_PORT,
+    config.READY_TIMEOUT,
+    config.METRICS_HOST,
+    config.METRICS_PORT,
+    config.METRICS_TOKEN
+)
 
 # ============================================================================
 # BOT CLASS
 # ============================================================================
 
-class SaveRestrictedBot(Client):
+class SaveRestrictedBot(PacedClient):
     """Main bot class"""
     
     def __init__(self):
@@ -762,12 +4532,52 @@ class SaveRestrictedBot(Client):
     async def start(self):
         """Start the bot"""
         await super().start()
+        storage_manager.sweep()
+        await db.ensure_indexes()
+        await broadcast_engine.resume_all(self)
+        await job_scheduler.resume(self)
         me = await self.get_me()
         logger.info(f"Bot started as @{me.username}")
         logger.info("Powered By @VJ_Bots")
     
+    async def save_file(
+        self,
+        path,
+        file_id: int = None,
+        file_part: int = 0,
+        progress=None,
+        progress_args: tuple = ()
+    ):
+        """Upload file, piping MediaStream sources without touching disk"""
+        if isinstance(path, MediaStream):
+            if file_id is not None:
+                # A stream cannot be rewound to re-send missing parts
+                raise IOError(f"Cannot resume streamed upload of {path.name}")
+            return await path.upload(self, progress, progress_args)
+        if file_id is None and parallel_uploader.applicable(path):
+            try:
+                return await parallel_uploader.upload(self, path, progress, progress_args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Parallel upload failed, falling back to sequential: {e}")
+        return await super().save_file(
+            path,
+            file_id=file_id,
+            file_part=file_part,
+            progress=progress,
+            progress_args=progress_args
+        )
+    
     async def stop(self, *args):
         """Stop the bot"""
+        # Jobs and broadcasts must stop before the clients they use go down
+        await job_scheduler.shutdown()
+        await broadcast_engine.shutdown()
+        await session_pool.close_all()
+        await account_pool.close_all()
+        await media_sessions.close_all()
+        await db.flush_activity()
         await super().stop()
         logger.info("Bot stopped")
 
@@ -788,10 +4598,7 @@ def create_bot_instance():
         """Handle /start command"""
         try:
             # Add user to database
-            if not await db.is_user_exist(message.from_user.id):
-                await db.add_user(message.from_user.id, message.from_user.first_name)
-            else:
-                await db.update_last_active(message.from_user.id)
+            await db.register_user(message.from_user.id, message.from_user.first_name)
             
             # Create buttons
             buttons = [
@@ -837,7 +4644,7 @@ def create_bot_instance():
     async def cmd_cancel(client: Client, message: Message):
         """Handle /cancel command"""
         try:
-            batch_manager.cancel_batch(message.from_user.id)
+            await job_scheduler.cancel(message.from_user.id)
             await client.send_message(
                 chat_id=message.chat.id,
                 text="**Batch Successfully Cancelled.**",
@@ -1014,6 +4821,7 @@ def create_bot_instance():
                 await db.set_session(message.from_user.id, string_session)
                 await db.set_api_id(message.from_user.id, api_id)
                 await db.set_api_hash(message.from_user.id, api_hash)
+                await session_pool.invalidate(message.from_user.id)
                 
                 await test_client.disconnect()
                 
@@ -1047,6 +4855,7 @@ def create_bot_instance():
                 return
             
             await db.set_session(message.from_user.id, None)
+            await session_pool.invalidate(message.from_user.id)
             await message.reply("**Logout Successfully** ♦")
             
         except Exception as e:
@@ -1057,86 +4866,44 @@ def create_bot_instance():
     # BROADCAST COMMAND (Admin Only)
     # ========================================================================
     
-    @bot.on_message(filters.command("broadcast") & filters.reply)
+    @bot.on_message(filters.command("broadcast"))
     async def cmd_broadcast(client: Client, message: Message):
-        """Handle /broadcast command"""
+        """Handle /broadcast [active:N] [logged_in] [sample:P] [dry] command"""
         try:
             # Check if user is admin
             if message.from_user.id not in config.ADMINS:
                 await message.reply("**You are not authorized to use this command.**")
                 return
             
+            args = message.command[1:]
+            dry_run = "dry" in args or "--dry-run" in args
+            try:
+                cohort = Cohort.parse([a for a in args if a not in ("dry", "--dry-run")])
+            except ValueError as e:
+                await message.reply(
+                    f"**Invalid cohort:** {e}\n\n"
+                    "Usage: `/broadcast [active:DAYS] [logged_in] [sample:PERCENT] [dry]`"
+                )
+                return
+            
+            if dry_run:
+                audience = await db.count_cohort(cohort)
+                await message.reply(
+                    f"**Dry run:** {audience} users match ({cohort.describe()})"
+                )
+                return
+            
             b_msg = message.reply_to_message
             if not b_msg:
                 await message.reply("**Reply this command to your broadcast message**")
                 return
             
             sts = await message.reply_text('Broadcasting your messages...')
+            total_users = await db.count_cohort(cohort)
             
-            start_time = time.time()
-            total_users = await db.total_users_count()
-            done = 0
-            success = 0
-            blocked = 0
-            deleted = 0
-            failed = 0
-            
-            async for user in await db.get_all_users():
-                if 'id' not in user:
-                    done += 1
-                    failed += 1
-                    continue
-                
-                user_id = user['id']
-                
-                try:
-                    await b_msg.copy(chat_id=user_id)
-                    success += 1
-                except FloodWait as e:
-                    await asyncio.sleep(e.value)
-                    try:
-                        await b_msg.copy(chat_id=user_id)
-                        success += 1
-                    except Exception:
-                        failed += 1
-                except InputUserDeactivated:
-                    await db.delete_user(user_id)
-                    deleted += 1
-                except UserIsBlocked:
-                    await db.delete_user(user_id)
-                    blocked += 1
-                except PeerIdInvalid:
-                    await db.delete_user(user_id)
-                    failed += 1
-                except Exception as e:
-                    logger.error(f"Broadcast error for user {user_id}: {e}")
-                    failed += 1
-                
-                done += 1
-                
-                # Update status every 20 users
-                if done % 20 == 0:
-                    await sts.edit(
-                        f"Broadcast in progress:\n\n"
-                        f"Total Users: {total_users}\n"
-                        f"Completed: {done} / {total_users}\n"
-                        f"Success: {success}\n"
-                        f"Blocked: {blocked}\n"
-                        f"Deleted: {deleted}\n"
-                        f"Failed: {failed}"
-                    )
-            
-            time_taken = timedelta(seconds=int(time.time() - start_time))
-            
-            await sts.edit(
-                f"Broadcast Completed:\n"
-                f"Completed in {time_taken} seconds.\n\n"
-                f"Total Users: {total_users}\n"
-                f"Completed: {done} / {total_users}\n"
-                f"Success: {success}\n"
-                f"Blocked: {blocked}\n"
-                f"Deleted: {deleted}\n"
-                f"Failed: {failed}"
+            await broadcast_engine.start(
+                client,
+                broadcast_engine.new_broadcast(b_msg, sts, total_users, cohort)
             )
             
         except Exception as e:
@@ -1155,10 +4922,41 @@ def create_bot_instance():
                 return
             
             total_users = await db.total_users_count()
+            pool = session_pool.stats()
+            edits = edit_scheduler.stats()
+            jobs = job_scheduler.stats()
+            accounts = "\n".join(
+                f"   • {a['name']}: {'ok' if a['healthy'] else 'disabled'}, {a['active']} active, "
+                f"{a['served']} served" + (f", flood {a['flood_left']:.0f}s" if a['flood_left'] else "")
+                for a in account_pool.stats()
+            )
+            pacing = "\n".join(
+                f"   • {name}: {state['rate']:.2f}/s ({state['flood_waits']} FloodWaits)"
+                for name, state in pacer.rates().items()
+            )
+            user_cache = db.cache_stats()
+            msg_cache = message_fetcher.stats()
+            thumbs = thumbnail_cache.stats()
+            storage = storage_manager.stats()
             
             await message.reply(
                 f"**📊 Bot Statistics**\n\n"
                 f"👥 Total Users: {total_users}\n"
+                f"⚙️ Jobs: {jobs['running']} running, {jobs['queued']} queued, "
+                f"{jobs['transfers']} transfers ({jobs['waiting']} waiting)\n"
+                f"🔌 User Sessions: {pool['open']} open, {pool['in_use']} busy\n"
+                f"♻️ Session Pool: {pool['hits']} hits / {pool['misses']} misses "
+                f"({pool['hit_rate']:.0%})\n"
+                f"🗄 User Cache: {user_cache['size']} cached, {user_cache['hit_rate']:.0%} hit rate\n"
+                f"📨 Message Cache: {msg_cache['size']} cached, {msg_cache['hit_rate']:.0%} hit rate\n"
+                f"🖼 Thumb Cache: {thumbs['entries']} thumbs, {humanbytes(thumbs['bytes'])}, "
+                f"{thumbs['hit_rate']:.0%} hit rate\n"
+                f"💾 Scratch: {humanbytes(storage['used'])} / {humanbytes(storage['limit'])} "
+                f"({storage['files']} files, {storage['rejected']} rejected)\n"
+                f"📝 Progress Edits: {edits['edits']} sent, {edits['skipped']} skipped, "
+                f"{edits['flood_waits']} FloodWaits (x{edits['backoff']:.1f})\n"
+                + (f"👤 Accounts:\n{accounts}\n" if accounts else "")
+                + f"🚦 Pacing:\n{pacing or '   • idle'}\n"
                 f"🤖 Bot: @{(await client.get_me()).username}"
             )
             
@@ -1174,145 +4972,68 @@ def create_bot_instance():
         """Handle text messages containing links"""
         try:
             # Update user activity
-            await db.update_last_active(message.from_user.id)
+            db.touch_user(message.from_user.id)
             
             # Handle join chat links
             if ("https://t.me/+" in message.text or 
                 "https://t.me/joinchat/" in message.text) and not config.LOGIN_SYSTEM:
                 
-                if TechVJUser is None:
+                if not account_pool.available:
                     await message.reply("String Session is not set")
                     return
                 
-                try:
-                    await TechVJUser.join_chat(message.text)
+                results = await account_pool.join_chat(message.text)
+                errors = [e for _, e in results if e is not None]
+                if len(errors) < len(results):
                     await message.reply("Chat Joined")
-                except UserAlreadyParticipant:
+                elif all(isinstance(e, UserAlreadyParticipant) for e in errors):
                     await message.reply("Chat already joined")
-                except InviteHashExpired:
+                elif any(isinstance(e, InviteHashExpired) for e in errors):
                     await message.reply("Invalid Link")
-                except Exception as e:
-                    logger.error(f"Join chat error: {e}")
-                    await message.reply(f"Error: {e}")
+                else:
+                    logger.error(f"Join chat error: {errors[0]}")
+                    await message.reply(f"Error: {errors[0]}")
                 return
             
             # Handle content download links
-            if "https://t.me/" in message.text:
-                # Check if user has active batch
-                if batch_manager.is_processing(message.from_user.id):
+            if "t.me/" in message.text:
+                segments = parse_links(message.text)
+                if not segments:
+                    await message.reply("**Invalid link format**")
+                    return
+                total = sum(len(segment) for segment in segments)
+                if total > config.MAX_BATCH_MESSAGES:
                     await message.reply(
-                        "**One Task Is Already Processing. Wait For Complete It. "
-                        "If You Want To Cancel This Task Then Use - /cancel**"
+                        f"**Too Many Messages ({total}). At Most {config.MAX_BATCH_MESSAGES} Per Request.**"
                     )
                     return
                 
-                # Parse message link
-                try:
-                    datas = message.text.split("/")
-                    temp = datas[-1].replace("?single", "").split("-")
-                    from_id = int(temp[0].strip())
-                    to_id = int(temp[1].strip()) if len(temp) > 1 else from_id
-                except Exception as e:
-                    logger.error(f"Link parsing error: {e}")
-                    await message.reply("**Invalid link format**")
-                    return
-                
-                # Setup user account
+                # Check login before queueing
                 if config.LOGIN_SYSTEM:
-                    user_data = await db.get_session(message.from_user.id)
-                    if user_data is None:
+                    user = await db.get_user(message.from_user.id)
+                    if not user or user.get('session') is None:
                         await message.reply(
                             "**For Downloading Restricted Content You Have To /login First.**"
                         )
                         return
-                    
-                    api_id = await db.get_api_id(message.from_user.id)
-                    api_hash = await db.get_api_hash(message.from_user.id)
-                    
-                    try:
-                        acc = Client(
-                            "saverestricted",
-                            session_string=user_data,
-                            api_hash=api_hash,
-                            api_id=api_id
-                        )
-                        await acc.connect()
-                    except Exception as e:
-                        logger.error(f"User client connection error: {e}")
-                        await message.reply(
-                            "**Your Login Session Expired. So /logout First Then Login Again By - /login**"
-                        )
-                        return
-                else:
-                    if TechVJUser is None:
-                        await message.reply("**String Session is not set**")
-                        return
-                    acc = TechVJUser
-                
-                # Start batch processing
-                batch_manager.start_batch(message.from_user.id)
+                elif not account_pool.available:
+                    await message.reply("**String Session is not set**")
+                    return
                 
+                job = BatchJob(message.from_user.id, message, segments)
                 try:
-                    for msg_id in range(from_id, to_id + 1):
-                        # Check if batch is cancelled
-                        if batch_manager.is_cancelled(message.from_user.id):
-                            break
-                        
-                        # Handle different chat types
-                        try:
-                            if "https://t.me/c/" in message.text:
-                                # Private chat
-                                chat_id = int("-100" + datas[4])
-                                await content_downloader.handle_private_message(
-                                    client, acc, message, chat_id, msg_id
-                                )
-                            
-                            elif "https://t.me/b/" in message.text:
-                                # Bot chat
-                                username = datas[4]
-                                await content_downloader.handle_private_message(
-                                    client, acc, message, username, msg_id
-                                )
-                            
-                            else:
-                                # Public chat
-                                username = datas[3]
-                                
-                                try:
-                                    msg = await client.get_messages(username, msg_id)
-                                    await client.copy_message(
-                                        message.chat.id,
-                                        msg.chat.id,
-                                        msg.id,
-                                        reply_to_message_id=message.id
-                                    )
-                                except UsernameNotOccupied:
-                                    await message.reply(
-                                        "The username is not occupied by anyone"
-                                    )
-                                    break
-                                except Exception:
-                                    await content_downloader.handle_private_message(
-                                        client, acc, message, username, msg_id
-                                    )
-                        
-                        except Exception as e:
-                            logger.error(f"Error processing message {msg_id}: {e}")
-                            if config.ERROR_MESSAGE:
-                                await message.reply(f"Error: {e}")
-                        
-                        # Wait between messages
-                        await asyncio.sleep(config.WAITING_TIME)
+                    position = await job_scheduler.submit(client, job)
+                except OverflowError as e:
+                    await message.reply(
+                        f"**Too Many Tasks Queued ({e}). Wait For Them Or Use - /cancel**"
+                    )
+                    return
                 
-                finally:
-                    # Cleanup
-                    batch_manager.stop_batch(message.from_user.id)
-                    
-                    if config.LOGIN_SYSTEM:
-                        try:
-                            await acc.disconnect()
-                        except Exception as e:
-                            logger.error(f"Error disconnecting user client: {e}")
+                if position:
+                    await message.reply(
+                        f"**Task Queued At Position {position}. "
+                        "It Will Start Automatically. Use - /cancel To Cancel.**"
+                    )
         
         except Exception as e:
             logger.error(f"Error handling text message: {e}")
@@ -1325,6 +5046,21 @@ def create_bot_instance():
 # MAIN FUNCTION
 # ============================================================================
 
+async def serve(bot: SaveRestrictedBot):
+    """Run the bot and its HTTP endpoints on one event loop"""
+    # Health answers (not ready) while everything else is still starting
+    status_server.bot = bot
+    await status_server.start()
+    try:
+        await initialize_user_client()
+        await bot.start()
+        await idle()
+        await bot.stop()
+    finally:
+        # Also reached when startup fails, user clients must not leak
+        await account_pool.close_all()
+        await status_server.stop()
+
 def main():
     """Main function to run the bot"""
     try:
@@ -1333,13 +5069,10 @@ def main():
             logger.error("Configuration validation failed")
             sys.exit(1)
         
-        # Initialize user client if needed
-        initialize_user_client()
-        
         # Create and run bot
         bot = create_bot_instance()
         logger.info("Starting bot...")
-        bot.run()
+        bot.run(serve(bot))
         
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
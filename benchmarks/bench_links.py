@@ -0,0 +1,80 @@
+"""
+Link parser benchmark
+Compares parse_links() against the old split('/') parser it replaced.
+
+Only the LINK PARSING section of VJ_Bots.py is loaded, so this runs
+without Pyrogram, Motor or any bot configuration:
+
+    python benchmarks/bench_links.py
+"""
+
+import ast
+import os
+import re
+import timeit
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple, Union
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "VJ_Bots.py")
+NAMES = ("MESSAGE_LINK", "LinkSegment", "parse_links")
+RUNS = 100000
+
+
+def load_parser():
+    """Execute just the link parsing definitions from VJ_Bots.py"""
+    with open(SOURCE, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    
+    namespace = {
+        're': re, 'dataclass': dataclass,
+        'Any': Any, 'Dict': Dict, 'List': List, 'Tuple': Tuple, 'Union': Union
+    }
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        else:
+            names = [getattr(node, 'name', None)]
+        if any(name in NAMES for name in names):
+            exec(compile(ast.Module([node], []), SOURCE, "exec"), namespace)
+    return namespace['parse_links']
+
+
+def old_parse(text: str):
+    """The single-link parser used before parse_links()"""
+    datas = text.split("/")
+    temp = datas[-1].replace("?single", "").split("-")
+    from_id = int(temp[0].strip())
+    to_id = int(temp[1].strip()) if len(temp) > 1 else from_id
+    if "https://t.me/c/" in text:
+        return int("-100" + datas[4]), False, from_id, to_id
+    if "https://t.me/b/" in text:
+        return datas[4], False, from_id, to_id
+    return datas[3], True, from_id, to_id
+
+
+def per_call_us(func, arg, runs: int) -> float:
+    return timeit.timeit(lambda: func(arg), number=runs) / runs * 1e6
+
+
+def main():
+    parse_links = load_parser()
+    link = "https://t.me/c/1234567890/1000-1100"
+    # 50 overlapping ranges that merge into a single segment
+    message = " ".join(
+        f"https://t.me/c/1234567890/{i * 50}-{i * 50 + 60}" for i in range(50)
+    )
+    
+    old = per_call_us(old_parse, link, RUNS)
+    new = per_call_us(parse_links, link, RUNS)
+    many = per_call_us(parse_links, message, RUNS // 50)
+    
+    print(f"old split parser:         {old:.1f} us per link")
+    print(f"parse_links, one link:    {new:.1f} us")
+    print(
+        f"parse_links, 50 links:    {many:.0f} us total ({many / 50:.1f} us per link), "
+        f"{len(parse_links(message))} segment(s)"
+    )
+
+
+if __name__ == "__main__":
+    main()